@@ -1,13 +1,17 @@
 import asyncio
 import logging
-from collections import defaultdict, deque
+import random
+import time
+import timeit
+from array import array
+from collections import defaultdict
 from datetime import datetime
+from functools import partial
 from io import BytesIO
-from typing import Optional
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
 import discord
 import prettytable
-from pytz import UTC
 from redbot.core import Config, checks, commands
 from redbot.core.utils.chat_formatting import box, inline, pagify
 from tsutils.cog_settings import CogSettings
@@ -23,6 +27,10 @@ logger = logging.getLogger('red.misc-cogs.automod')
 
 # Make sure to change the docstring in resetmessagecount when changing this
 LOGS_PER_CHANNEL_USER = 10
+# A user's image log in a channel is forgotten once it has been idle for this long, or for the
+# channel's image interval if that is longer
+IMAGE_LOG_TTL = 60 * 60
+IMAGE_LOG_SWEEP_SECONDS = 5 * 60
 
 AUTOMOD_HELP = r"""
 Automod works by creating named global patterns, and then applying them in
@@ -103,11 +111,29 @@ class AutoMod(commands.Cog):
                                      imagelimit_enabled=False, embedlimit_enabled=False, embed_limit=2)
 
         self.settings = AutoMod2Settings('automod2', bot)
-        self.channel_user_logs = defaultdict(lambda: deque(maxlen=LOGS_PER_CHANNEL_USER))
+        self.image_logs = ImageTracker()
 
         self.server_user_last = defaultdict(dict)
         self.server_phrase_last = defaultdict(dict)
 
+        # guild_id -> compiled patterns and channel rules, rebuilt after any pattern or list edit
+        self.rule_sets: Dict[int, GuildRules] = {}
+        self.rule_versions = defaultdict(int)
+        # guild_id -> rule name -> stats, kept across rebuilds of the guild's rules
+        self.pattern_stats: Dict[int, Dict[str, PatternStats]] = defaultdict(dict)
+
+        # Run in order on every message, sharing one MessageContext
+        self.message_stages = [
+            ('embeds', self.mod_message_embeds),
+            ('images', self.mod_message_images),
+            ('patterns', self.mod_message),
+            ('invites', self.check_invites),
+            ('autoemojis', self.add_auto_emojis),
+            ('watchdog', self.mod_message_watchdog),
+        ]
+        # stage name -> latency, including 'config' for loading the context
+        self.stage_stats: Dict[str, StageStats] = defaultdict(StageStats)
+
     async def red_get_data_for_user(self, *, user_id):
         """Get a user's personal data."""
         watchlisted = 0
@@ -200,6 +226,8 @@ class AutoMod(commands.Cog):
             return
         async with self.config.guild(ctx.guild).patterns() as patterns:
             patterns[name] = {'include_pattern': include_pattern, 'exclude_pattern': exclude_pattern, 'uses': 0}
+        self.pattern_stats[ctx.guild.id].pop(name, None)
+        self.invalidate_rules(ctx.guild)
         await ctx.tick()
 
     @automod.command()
@@ -215,6 +243,8 @@ class AutoMod(commands.Cog):
                 await ctx.send(f"Rule '{name}' is in use.")
                 return
             del patterns[name]
+        self.pattern_stats[ctx.guild.id].pop(name, None)
+        self.invalidate_rules(ctx.guild)
         await ctx.tick()
 
     @automod.command()
@@ -232,6 +262,7 @@ class AutoMod(commands.Cog):
                 if name not in whitelist:
                     whitelist.append(name)
                     patterns[name]['uses'] += 1
+        self.invalidate_rules(channel.guild)
         await ctx.tick()
 
     @automod.command()
@@ -249,6 +280,7 @@ class AutoMod(commands.Cog):
                     return
                 whitelist.remove(name)
                 patterns[name]['uses'] -= 1
+        self.invalidate_rules(channel.guild)
         await ctx.tick()
 
     @automod.command()
@@ -266,6 +298,7 @@ class AutoMod(commands.Cog):
                 if name not in blacklist:
                     blacklist.append(name)
                     patterns[name]['uses'] += 1
+        self.invalidate_rules(channel.guild)
         await ctx.tick()
 
     @automod.command()
@@ -283,6 +316,7 @@ class AutoMod(commands.Cog):
                     return
                 blacklist.remove(name)
                 patterns[name]['uses'] -= 1
+        self.invalidate_rules(channel.guild)
         await ctx.tick()
 
     @automod.command(name='list')
@@ -331,6 +365,38 @@ class AutoMod(commands.Cog):
         for page in pagify(output):
             await ctx.send(box(page))
 
+    @automod.group(invoke_without_command=True)
+    @commands.guild_only()
+    @checks.mod_or_permissions(manage_guild=True)
+    async def patternstats(self, ctx):
+        """Show how often each pattern was checked and matched, and how long it took.
+
+        Patterns that keep timing out are disabled.  Use patternstats reset to clear the
+        stats and re-enable them.
+        """
+        stats = self.pattern_stats.get(ctx.guild.id, {})
+        if not stats:
+            await ctx.send("No patterns have been checked yet.")
+            return
+
+        tbl = prettytable.PrettyTable(["Rule Name", "Checks", "Hits", "Avg us", "Max ms", "Timeouts", "Status"])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for name, rule_stats in sorted(stats.items(), key=lambda item: -item[1].total):
+            tbl.add_row([name, rule_stats.evaluations, rule_stats.hits, round(rule_stats.average() * 10 ** 6, 1),
+                         round(rule_stats.max * 1000, 2), rule_stats.timeouts,
+                         'disabled' if rule_stats.disabled else 'ok'])
+        for page in pagify(strip_right_multiline(tbl.get_string())):
+            await ctx.send(box(page))
+
+    @patternstats.command(name='reset')
+    async def ps_reset(self, ctx):
+        """Clear the pattern stats and re-enable any disabled patterns."""
+        self.pattern_stats.pop(ctx.guild.id, None)
+        self.invalidate_rules(ctx.guild)
+        await ctx.tick()
+
     @automod.group()
     @commands.guild_only()
     @checks.mod_or_permissions(manage_guild=True)
@@ -457,19 +523,58 @@ class AutoMod(commands.Cog):
                        allowed_mentions=discord.AllowedMentions(roles=False))
 
     @commands.Cog.listener('on_message')
-    async def mod_message_embeds(self, message):
-        if message.author.id == self.bot.user.id or isinstance(message.channel, (discord.DMChannel, discord.Thread)):
-            return
-        if not isinstance(message.author, discord.Member):
+    async def automod_message(self, message):
+        if message.author.id == self.bot.user.id or isinstance(message.channel, discord.abc.PrivateChannel):
             return
-        if message.channel.permissions_for(message.author).manage_messages:
+
+        before_time = timeit.default_timer()
+        context = await self.message_context(message)
+        self.stage_stats['config'].record(timeit.default_timer() - before_time)
+
+        for name, stage in self.message_stages:
+            before_time = timeit.default_timer()
+            try:
+                await stage(message, context)
+            except Exception:
+                logger.exception("AutoMod stage %s failed", name)
+            self.stage_stats[name].record(timeit.default_timer() - before_time)
+
+    async def message_context(self, message) -> 'MessageContext':
+        return MessageContext(message,
+                              await self.config.guild(message.guild).all(),
+                              await self.config.channel(message.channel).all())
+
+    @automod.group(invoke_without_command=True)
+    @checks.is_owner()
+    async def stagetimes(self, ctx):
+        """Show how long each on_message stage has taken, including any Discord calls it made."""
+        await ctx.send(box(self.stage_times_table()))
+
+    @stagetimes.command(name='reset')
+    async def st_reset(self, ctx):
+        """Show the stage times, then clear them."""
+        await ctx.send(box(self.stage_times_table()))
+        self.stage_stats.clear()
+
+    def stage_times_table(self) -> str:
+        tbl = prettytable.PrettyTable(['Stage', 'Calls', 'Avg ms', 'Max ms'])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for name in ['config'] + [name for name, _ in self.message_stages]:
+            stats = self.stage_stats[name]
+            tbl.add_row([name, stats.count, round(stats.average() * 1000, 3), round(stats.max * 1000, 3)])
+        return tbl.get_string()
+
+    async def mod_message_embeds(self, message, context):
+        if context.in_thread or not context.moderated:
             return
-        if not await self.config.channel(message.channel).embedlimit_enabled():
+        if not context.channel_config['embedlimit_enabled']:
             return
-        immune_rids = await self.config.guild(message.guild).embed_immune_role_ids()
+        immune_rids = context.guild_config['embed_immune_role_ids']
         if any(role.id in immune_rids for role in message.author.roles):
             return
-        embed_limit = await self.config.channel(message.channel).embed_limit()
+        embed_limit = context.channel_config['embed_limit']
         if len(message.embeds) <= embed_limit:
             return
         
@@ -489,99 +594,128 @@ class AutoMod(commands.Cog):
         await self.config.channel(channel or ctx.channel).image_only.set(enabled)
         await ctx.tick()
 
-    @commands.Cog.listener('on_message')
-    async def mod_message_images(self, message):
-        if message.author.id == self.bot.user.id or isinstance(message.channel, (discord.DMChannel, discord.Thread)):
-            return
-        if not isinstance(message.author, discord.Member):
-            return
-        if message.channel.permissions_for(message.author).manage_messages:
+    async def mod_message_images(self, message, context):
+        if context.in_thread or not context.moderated:
             return
-        if not await self.config.channel(message.channel).imagelimit_enabled():
+        if not context.channel_config['imagelimit_enabled']:
             return
-        immune_rids = await self.config.guild(message.guild).immune_role_ids()
+        immune_rids = context.guild_config['immune_role_ids']
         if any(role.id in immune_rids for role in message.author.roles):
             return
 
-        if await self.config.channel(message.channel).image_only():
+        if context.channel_config['image_only']:
             if len(message.embeds) or len(message.attachments):
                 return
             msg = f"Your message in {message.channel.name} was deleted for not containing an image"
             await self.deleteAndReport(message, msg)
             return
 
-        seconds = await self.config.channel(message.channel).image_reset_minutes() * 60
-        message_count = await self.config.channel(message.channel).reset_message_count()
-        image_limit = await self.config.channel(message.channel).image_limit()
+        seconds = context.channel_config['image_reset_minutes'] * 60
+        message_count = context.channel_config['reset_message_count']
+        image_limit = context.channel_config['image_limit']
 
         key = (message.channel.id, message.author.id)
-        self.channel_user_logs[key].append(message)
+        now = time.time()
+        image_log = self.image_logs.get(key, now, max(seconds, IMAGE_LOG_TTL))
+        image_log.append(message.id, message.created_at.timestamp(), linked_img_count(message))
 
-        user_logs = list(self.channel_user_logs[key])[-message_count:]
-        count = 0
-        for m in user_logs:
-            if seconds == -60 or (datetime.now(UTC) - m.created_at).total_seconds() < seconds:
-                count += linked_img_count(m)
+        user_logs = image_log.recent(message_count, now - seconds if seconds > 0 else None)
+        count = sum(images for _, images in user_logs)
         if count == 0:
-            self.channel_user_logs[key].clear()
+            self.image_logs.forget(key)
         if count <= image_limit:
             return
 
-        for m in user_logs:
-            if seconds == -60 or (datetime.now(UTC) - m.created_at).total_seconds() < seconds:
-                if linked_img_count(m) > 0:
-                    try:
-                        await m.delete()
-                    except Exception:
-                        pass
+        await self.delete_messages(message.channel, [message_id for message_id, images in user_logs if images])
 
-        self.channel_user_logs[key].clear()
+        self.image_logs.forget(key)
         msg = f"{message.author.mention} Upload multiple images to an imgbb album #endimagespam"
         await message.channel.send(msg)
 
     @commands.Cog.listener('on_message_edit')
     async def mod_message_edit(self, before, after):
-        await self.mod_message(after)
-
-    @commands.Cog.listener('on_message')
-    async def mod_message(self, message):
-        if isinstance(message.channel, discord.abc.PrivateChannel):
-            return
-        if message.author.bot or not isinstance(message.author, discord.Member):
+        if isinstance(after.channel, discord.abc.PrivateChannel):
             return
-        if message.channel.permissions_for(message.author).manage_messages:
+        await self.mod_message(after, await self.message_context(after))
+
+    async def mod_message(self, message, context):
+        if message.author.bot or not context.moderated:
             return
 
-        whitelists = await self.config.channel(message.channel).whitelist()
-        blacklists = await self.config.channel(message.channel).blacklist()
+        whitelists, blacklist = await self.channel_rules(message.channel)
 
         msg_content = message.clean_content
-        for name in blacklists:
-            pattern = (await self.config.guild(message.guild).patterns())[name]
-            include_pattern = pattern['include_pattern']
-            exclude_pattern = pattern['exclude_pattern']
-
-            if not matchesIncludeExclude(include_pattern, exclude_pattern, msg_content):
-                continue
-
+        violated = blacklist.matching(msg_content)
+        # Disabled rules are left out, so a whitelist made only of them allows everything
+        whitelists = [rule for rule in whitelists if not rule.stats.disabled]
+        await self.report_disabled_rules(message.guild, blacklist.rules + whitelists)
+        if violated:
             await self.deleteAndReport(message,
                                        box(f"Your message in {message.channel.name} was deleted for violating"
-                                           f" the following policy: {name}\nMessage content: {msg_content}"))
+                                           f" the following policy: {','.join(rule.name for rule in violated)}"
+                                           f"\nMessage content: {msg_content}"))
+            return
 
         if whitelists:
             failed_whitelists = []
-            for name in whitelists:
-                pattern = (await self.config.guild(message.guild).patterns())[name]
-                include_pattern = pattern['include_pattern']
-                exclude_pattern = pattern['exclude_pattern']
-
-                if matchesIncludeExclude(include_pattern, exclude_pattern, msg_content):
+            for rule in whitelists:
+                # A whitelist rule that times out lets the message through
+                if rule.matches(msg_content, on_timeout=True):
                     return
-                failed_whitelists.append(name)
+                failed_whitelists.append(rule.name)
             await self.deleteAndReport(message, box(f"Your message in {message.channel.name} was deleted for violating"
                                                     f" the following policy: {','.join(failed_whitelists)}"
                                                     f"\nMessage content: {msg_content}"))
 
+    async def report_disabled_rules(self, guild, rules: List['CompiledRule']):
+        for rule in rules:
+            if rule.stats.disabled and not rule.stats.reported:
+                rule.stats.reported = True
+                await self._watchdog_show(guild, f"**AutoMod:** rule [{rule.name}] was disabled after timing out"
+                                                 f" {rule.stats.timeouts} times. Fix it with addpattern, or use"
+                                                 f" `automod patternstats reset` to re-enable it.")
+
+    def invalidate_rules(self, guild):
+        """Drop the guild's compiled rules, including any build still reading the old config."""
+        self.rule_versions[guild.id] += 1
+        self.rule_sets.pop(guild.id, None)
+
+    async def channel_rules(self, channel) -> Tuple[List['CompiledRule'], 'BlacklistMatcher']:
+        """The compiled whitelist rules and blacklist matcher for a channel."""
+        guild_id = channel.guild.id
+        rule_set = self.rule_sets.get(guild_id)
+        if rule_set is None:
+            version = self.rule_versions[guild_id]
+            rule_set = GuildRules(await self.config.guild(channel.guild).patterns(), version,
+                                  self.pattern_stats[guild_id])
+
+        rules = rule_set.channels.get(channel.id)
+        if rules is None:
+            whitelist = await self.config.channel(channel).whitelist()
+            blacklist = await self.config.channel(channel).blacklist()
+            rules = rule_set.channels[channel.id] = (rule_set.resolve(whitelist),
+                                                     BlacklistMatcher(rule_set.resolve(blacklist)))
+
+        if rule_set.version == self.rule_versions[guild_id]:
+            self.rule_sets[guild_id] = rule_set
+        return rules
+
+    @automod.command()
+    @checks.is_owner()
+    async def patternbench(self, ctx, messages: int = 10000, patterns: int = 50):
+        """Time matching a synthetic message mix against a set of synthetic patterns."""
+        messages = max(1, min(messages, 1000000))
+        patterns = max(1, min(patterns, 500))
+        build_seconds, results = benchmark_rules(synthetic_patterns(patterns), synthetic_texts(messages))
+
+        tbl = prettytable.PrettyTable(['Rules', 'Messages', 'Patterns', 'Matched', 'us/msg'])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for label, matched, seconds in results:
+            tbl.add_row([label, messages, patterns, matched, round(seconds / messages * 10 ** 6, 2)])
+        await ctx.send(box(tbl.get_string() + '\n\nBuilt in {:.2f}ms'.format(build_seconds * 1000)))
+
     @automod.command()
     @commands.guild_only()
     @checks.mod_or_permissions(manage_guild=True)
@@ -596,11 +730,8 @@ class AutoMod(commands.Cog):
         else:
             await ctx.send("Autoemojis is configured for this channel.")
 
-    @commands.Cog.listener('on_message')
-    async def add_auto_emojis(self, message):
-        if message.author.id == self.bot.user.id or isinstance(message.channel, discord.abc.PrivateChannel):
-            return
-        emoji_list = await self.config.channel(message.channel).autoemoji()
+    async def add_auto_emojis(self, message, context):
+        emoji_list = context.channel_config['autoemoji']
         if '[noemojis]' in message.content:
             return
         for emoji in emoji_list:
@@ -611,11 +742,8 @@ class AutoMod(commands.Cog):
         await self.config.guild(ctx.guild).blockinvites.set(enable)
         await send_confirmation_message(ctx, f"Invite blocking has been {'enabled' if enable else 'disabled'}.")
 
-    @commands.Cog.listener('on_message')
-    async def check_invites(self, message: discord.Message):
-        if message.author.id == self.bot.user.id or isinstance(message.channel, discord.abc.PrivateChannel):
-            return
-        if not await self.config.guild(message.guild).blockinvites():
+    async def check_invites(self, message: discord.Message, context):
+        if not context.guild_config['blockinvites']:
             return
         if (codes := re.findall(r'discord\.gg/([\w]+)', message.content)) is None:
             return
@@ -776,20 +904,17 @@ class AutoMod(commands.Cog):
         await self.config.guild(ctx.guild).watchdog_channel_id.set(channel.id)
         await ctx.tick()
 
-    @commands.Cog.listener('on_message')
-    async def mod_message_watchdog(self, message):
-        if message.author.id == self.bot.user.id or isinstance(message.channel, discord.abc.PrivateChannel):
-            return
-        if await self.config.guild(message.guild).watchdog_channel_id() is None:
+    async def mod_message_watchdog(self, message, context):
+        if context.guild_config['watchdog_channel_id'] is None:
             return
 
-        await self.mod_message_watchdog_user(message)
-        await self.mod_message_watchdog_phrase(message)
+        await self.mod_message_watchdog_user(message, context)
+        await self.mod_message_watchdog_phrase(message, context)
 
-    async def mod_message_watchdog_user(self, message):
+    async def mod_message_watchdog_user(self, message, context):
         user_id = message.author.id
         server_id = message.guild.id
-        user_settings = (await self.config.guild(message.guild).watched_users()).get(str(message.author.id))
+        user_settings = context.guild_config['watched_users'].get(str(message.author.id))
 
         if user_settings is None:
             return
@@ -818,10 +943,10 @@ class AutoMod(commands.Cog):
             request_user_txt, reason, box(message.clean_content))
         await self._watchdog_show(message.guild, output_msg)
 
-    async def mod_message_watchdog_phrase(self, message):
+    async def mod_message_watchdog_phrase(self, message, context):
         server_id = message.guild.id
 
-        for name, phrase_settings in (await self.config.guild(message.guild).phrases()).items():
+        for name, phrase_settings in context.guild_config['phrases'].items():
             cooldown = phrase_settings['cooldown']
             request_user_id = phrase_settings['request_user_id']
             phrase = phrase_settings['phrase']
@@ -838,7 +963,12 @@ class AutoMod(commands.Cog):
                 continue
 
             p = re.compile(phrase, re.IGNORECASE | re.MULTILINE | re.DOTALL)
-            if p.match(message.clean_content):
+            try:
+                matched = p.match(message.clean_content, **TIMEOUT_KWARGS)
+            except TimeoutError:
+                logger.warning("Watchdog phrase %s timed out", name)
+                continue
+            if matched:
                 self.server_phrase_last[server_id][name] = now
                 output_msg = "**Watchdog:** {} spoke in {} `(rule [{}] matched phrase [{}])`\n{}".format(
                     message.author.mention, message.channel.mention,
@@ -855,6 +985,20 @@ class AutoMod(commands.Cog):
         except Exception:
             logger.exception("Failed to watchdog")
 
+    async def delete_messages(self, channel, message_ids: List[int]):
+        """Delete messages by id, in one bulk request where Discord allows it."""
+        try:
+            await channel.delete_messages([discord.Object(id=message_id) for message_id in message_ids])
+            return
+        except (discord.HTTPException, discord.ClientException):
+            # Bulk delete refuses messages older than two weeks, or any it can't find
+            pass
+        for message_id in message_ids:
+            try:
+                await channel.get_partial_message(message_id).delete()
+            except Exception:
+                pass
+
     async def deleteAndReport(self, delete_msg, outgoing_msg):
         try:
             await delete_msg.delete()
@@ -904,26 +1048,369 @@ CUSTOM_PATTERNS = {
 }
 
 
-def matchesIncludeExclude(include_pattern, exclude_pattern, txt):
-    if matchesPattern(include_pattern, txt):
-        return not matchesPattern(exclude_pattern, txt)
-    return False
+PATTERN_FLAGS = re.IGNORECASE | re.MULTILINE | re.DOTALL
 
+# Seconds a single regex may run on a message before it gives up, and how many timeouts disable a rule.
+# Only the regex module supports timeouts; the re fallback runs patterns unbounded.
+PATTERN_TIMEOUT = 0.05
+PATTERN_TIMEOUT_LIMIT = 3
+TIMEOUT_KWARGS = {'timeout': PATTERN_TIMEOUT} if re.__name__ == 'regex' else {}
 
-def matchesPattern(pattern, txt):
-    if not len(pattern):
-        return False
+# An include that is just ASCII words, optionally after a leading .* (and before a trailing one)
+LITERAL_INCLUDE = re.compile(r'(\.\*)?([a-zA-Z0-9 ]+)(?:\.\*)?')
 
-    try:
-        if pattern[0] == pattern[-1] == ':':
-            check_method = CUSTOM_PATTERNS.get(pattern[1:-1])
-            if check_method:
+
+def is_custom_pattern(pattern: str) -> bool:
+    return len(pattern) > 1 and pattern[0] == pattern[-1] == ':' and pattern[1:-1] in CUSTOM_PATTERNS
+
+
+def compile_pattern(pattern: str) -> Callable[[str], bool]:
+    """A function that checks text against pattern, either a regex or a :custom_pattern: name."""
+    if not pattern:
+        return lambda txt: False
+
+    if is_custom_pattern(pattern):
+        check_method = CUSTOM_PATTERNS[pattern[1:-1]]
+
+        def check(txt):
+            try:
                 return check_method(txt)
-    except Exception:
-        return False
+            except Exception:
+                return False
+
+        return check
 
-    p = re.compile(pattern, re.IGNORECASE | re.MULTILINE | re.DOTALL)
-    return p.match(txt)
+    try:
+        return partial(re.compile(search_form(pattern), PATTERN_FLAGS).search, **TIMEOUT_KWARGS)
+    except re.error:
+        return partial(re.compile(pattern, PATTERN_FLAGS).match, **TIMEOUT_KWARGS)
+
+
+def search_form(pattern: str) -> str:
+    """A pattern that finds a match anywhere in a text exactly when pattern matches at its start.
+
+    With DOTALL a leading .* can skip any prefix, so it is dropped unless the rest has a top level
+    alternation it doesn't apply to, or starts with a quantifier modifier.  Anything else is
+    anchored to the start.  Searching lets the regex engine skip ahead to a literal prefix, where
+    .* would try every position by backtracking.
+    """
+    rest = pattern[2:]
+    if pattern.startswith('.*') and rest[:1] not in ('?', '+', '*', '{') and not has_top_level_alternation(rest):
+        return rest
+    return r'\A(?:{})'.format(pattern)
+
+
+def has_top_level_alternation(pattern: str) -> bool:
+    depth = 0
+    in_class = False
+    idx = 0
+    while idx < len(pattern):
+        char = pattern[idx]
+        if char == '\\':
+            idx += 1
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+            # A ] straight after the opening [ (or [^) is a literal
+            if pattern[idx + 1:idx + 2] == '^':
+                idx += 1
+            if pattern[idx + 1:idx + 2] == ']':
+                idx += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        idx += 1
+    return False
+
+
+class PatternStats:
+    """How often a rule was checked and matched, and how long that took."""
+    __slots__ = ('evaluations', 'hits', 'total', 'max', 'timeouts', 'disabled', 'reported')
+
+    def __init__(self):
+        self.evaluations = 0
+        self.hits = 0
+        self.total = 0
+        self.max = 0
+        self.timeouts = 0
+        # Disabled after PATTERN_TIMEOUT_LIMIT timeouts, until the pattern is replaced or stats reset
+        self.disabled = False
+        self.reported = False
+
+    def record(self, seconds: float, hit: bool):
+        self.evaluations += 1
+        self.hits += hit
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def record_timeout(self, seconds: float):
+        self.record(seconds, False)
+        self.timeouts += 1
+        self.disabled = self.timeouts >= PATTERN_TIMEOUT_LIMIT
+
+    def average(self) -> float:
+        return self.total / self.evaluations if self.evaluations else 0
+
+
+class CompiledRule:
+    """A named include/exclude pattern pair, compiled once."""
+    __slots__ = ('name', 'include_pattern', 'include', 'exclude', 'literal', 'stats')
+
+    def __init__(self, name: str, include_pattern: str, exclude_pattern: str, stats: PatternStats = None):
+        self.name = name
+        self.include_pattern = include_pattern
+        self.stats = stats or PatternStats()
+        try:
+            self.include = compile_pattern(include_pattern)
+            self.exclude = compile_pattern(exclude_pattern)
+        except Exception:
+            logger.exception("Failed to compile rule %s, it will never match", name)
+            self.include_pattern = ''
+            self.include = self.exclude = compile_pattern('')
+
+        # (lowercased words, whether they may appear anywhere rather than only at the start)
+        self.literal = None
+        if (literal := LITERAL_INCLUDE.fullmatch(self.include_pattern)) is not None:
+            self.literal = literal.group(2).lower(), bool(literal.group(1))
+
+    def matches(self, txt: str, lowered: str = None, on_timeout: bool = False) -> bool:
+        """Whether txt matches the include and not the exclude.
+
+        A word include is checked against lowered, txt.lower() if not given.  If the rule is
+        disabled or a regex times out, on_timeout is returned instead.
+        """
+        stats = self.stats
+        if stats.disabled:
+            return on_timeout
+
+        before_time = timeit.default_timer()
+        try:
+            if self.literal is not None:
+                words, anywhere = self.literal
+                lowered = txt.lower() if lowered is None else lowered
+                included = (words in lowered) if anywhere else lowered.startswith(words)
+            else:
+                included = bool(self.include(txt))
+            matched = included and not self.exclude(txt)
+        except TimeoutError:
+            stats.record_timeout(timeit.default_timer() - before_time)
+            logger.warning("Rule %s timed out (%d times)%s", self.name, stats.timeouts,
+                           ', disabling it' if stats.disabled else '')
+            return on_timeout
+        stats.record(timeit.default_timer() - before_time, matched)
+        return matched
+
+
+class GuildRules:
+    """A server's compiled patterns, and each channel's whitelist and blacklist rules.
+
+    Built from the config once per `version`; AutoMod bumps the version whenever a pattern or a
+    channel list is edited, so a set built from stale config is never cached.  Rules take their
+    PatternStats from `stats`, so counts and disabled rules carry over into the next build.
+    """
+
+    def __init__(self, patterns: dict, version: int, stats: Dict[str, PatternStats]):
+        self.version = version
+        self.rules = {name: CompiledRule(name, pattern['include_pattern'], pattern['exclude_pattern'],
+                                         stats.setdefault(name, PatternStats()))
+                      for name, pattern in patterns.items()}
+        # channel_id -> (whitelist, blacklist), filled in as channels are seen
+        self.channels: Dict[int, Tuple[List[CompiledRule], BlacklistMatcher]] = {}
+
+    def resolve(self, names: Sequence[str]) -> List[CompiledRule]:
+        return [self.rules[name] for name in names if name in self.rules]
+
+
+class BlacklistMatcher:
+    """Finds every rule in a channel's blacklist that a text violates, in one pass over the rules.
+
+    Includes that are just words are checked by substring search on the text, lowercased once for
+    all of them, and the rest by their compiled include.  Excludes only run for rules whose
+    include matched.  A rule that times out is treated as not violated.
+    """
+
+    def __init__(self, rules: Sequence[CompiledRule]):
+        self.rules = list(rules)
+        self.any_literal = any(rule.literal is not None for rule in self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def matching(self, txt: str) -> List[CompiledRule]:
+        """The rules txt violates, in blacklist order."""
+        lowered = txt.lower() if self.any_literal else None
+        return [rule for rule in self.rules if rule.matches(txt, lowered)]
+
+
+SPAM_WORDS = ['trade', 'sell', 'buy', 'account', 'free', 'nitro', 'giveaway', 'gift', 'invite', 'steam',
+              'crypto', 'airdrop', 'promo', 'cheap', 'boost', 'modded', 'hack', 'casino', 'bonus', 'claim']
+
+
+def synthetic_patterns(count: int) -> Dict[str, dict]:
+    """Deterministic patterns in roughly the mix servers configure."""
+    rng = random.Random(count)
+    words = SPAM_WORDS
+    makers = [
+        (0.35, lambda: (r'.*\b{}\b.*'.format(rng.choice(words)), '')),
+        (0.25, lambda: (r'.*{} {}.*'.format(rng.choice(words), rng.choice(words)), '')),
+        (0.2, lambda: (r'.*({}|{}).*'.format(rng.choice(words), rng.choice(words)),
+                       r'.*{}.*'.format(rng.choice(words)))),
+        (0.1, lambda: (r'.*https?://\S+\.{}\b.*'.format(rng.choice(['gg', 'ly', 'ru'])), '')),
+        (0.05, lambda: (r'.*(.)\1{9,}.*', '')),
+        (0.05, lambda: (':starts_with_code:', '')),
+    ]
+    weights = [weight for weight, _ in makers]
+    chosen = rng.choices([make for _, make in makers], weights, k=count)
+    return {'rule {}'.format(idx): dict(zip(('include_pattern', 'exclude_pattern'), make()))
+            for idx, make in enumerate(chosen)}
+
+
+def synthetic_texts(count: int) -> List[str]:
+    """Deterministic chat messages, a few of them with spam words, links or room codes."""
+    rng = random.Random(count)
+    words = ['whale', 'carry', 'team', 'dungeon', 'pull', 'the', 'a', 'is', 'on', 'my', 'for', 'and', 'lol',
+             'anyone', 'help', 'with', 'this', 'rem', 'stamina', 'https://example.com/x']
+    texts = []
+    for _ in range(count):
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 40)))
+        if rng.random() < 0.05:
+            text = '{} {}'.format(text, rng.choice(SPAM_WORDS))
+        if rng.random() < 0.2:
+            text = '{:04d} {:04d} {}'.format(rng.randrange(10 ** 4), rng.randrange(10 ** 4), text)
+        texts.append(text)
+    return texts
+
+
+def benchmark_rules(patterns: Dict[str, dict], texts: List[str]):
+    """Seconds to build the rules, then (label, matched, seconds) for matching every text against them.
+
+    'uncached' compiles each rule for every message, which is what every message used to pay.
+    'blacklist' checks them as one channel blacklist would.
+    """
+    results = []
+
+    before_time = timeit.default_timer()
+    rules = list(GuildRules(patterns, 0, {}).rules.values())
+    blacklist = BlacklistMatcher(rules)
+    build_seconds = timeit.default_timer() - before_time
+
+    before_time = timeit.default_timer()
+    matched = sum(rule.matches(text) for text in texts for rule in rules)
+    results.append(('compiled', matched, timeit.default_timer() - before_time))
+
+    before_time = timeit.default_timer()
+    matched = sum(len(blacklist.matching(text)) for text in texts)
+    results.append(('blacklist', matched, timeit.default_timer() - before_time))
+
+    before_time = timeit.default_timer()
+    matched = sum(CompiledRule(name, pattern['include_pattern'], pattern['exclude_pattern']).matches(text)
+                  for text in texts for name, pattern in patterns.items())
+    results.append(('uncached', matched, timeit.default_timer() - before_time))
+
+    return build_seconds, results
+
+
+class ImageLog:
+    """The last LOGS_PER_CHANNEL_USER messages a user sent in a channel, oldest first.
+
+    Each is kept as just its id, creation time in milliseconds and image count, three slots of one
+    flat array.  The array grows to LOGS_PER_CHANNEL_USER entries and is then reused as a ring.
+    """
+    __slots__ = ('entries', 'start', 'expires_at')
+
+    def __init__(self):
+        self.entries = array('Q')
+        self.start = 0
+        self.expires_at = 0
+
+    def __len__(self):
+        return len(self.entries) // 3
+
+    def append(self, message_id: int, created_at: float, images: int):
+        entry = (message_id, int(created_at * 1000), images)
+        if len(self) < LOGS_PER_CHANNEL_USER:
+            self.entries.extend(entry)
+        else:
+            self.entries[self.start * 3:self.start * 3 + 3] = array('Q', entry)
+            self.start = (self.start + 1) % LOGS_PER_CHANNEL_USER
+
+    def recent(self, count: int, since: Optional[float] = None) -> List[Tuple[int, int]]:
+        """(message_id, images) for the last count messages, leaving out any created before since."""
+        size = len(self)
+        since_ms = None if since is None else since * 1000
+        logs = []
+        for offset in range(max(size - count, 0), size):
+            idx = (self.start + offset) % size * 3
+            if since_ms is None or self.entries[idx + 1] > since_ms:
+                logs.append((self.entries[idx], self.entries[idx + 2]))
+        return logs
+
+
+class ImageTracker:
+    """ImageLogs by (channel_id, user_id), each forgotten once idle for longer than its ttl.
+
+    Expired logs are swept at most once every IMAGE_LOG_SWEEP_SECONDS, as logs are fetched, so
+    only users who sent images in a limited channel recently take up memory.
+    """
+
+    def __init__(self):
+        self.logs: Dict[Tuple[int, int], ImageLog] = {}
+        self._last_sweep = 0
+
+    def __len__(self):
+        return len(self.logs)
+
+    def get(self, key: Tuple[int, int], now: float, ttl: float) -> ImageLog:
+        """The log for key, created if needed, kept for at least ttl seconds from now."""
+        if now - self._last_sweep > IMAGE_LOG_SWEEP_SECONDS:
+            self.sweep(now)
+        image_log = self.logs.get(key)
+        if image_log is None:
+            image_log = self.logs[key] = ImageLog()
+        image_log.expires_at = now + ttl
+        return image_log
+
+    def forget(self, key: Tuple[int, int]):
+        self.logs.pop(key, None)
+
+    def sweep(self, now: float):
+        self._last_sweep = now
+        for key in [key for key, image_log in self.logs.items() if image_log.expires_at < now]:
+            del self.logs[key]
+
+
+class MessageContext:
+    """What every on_message stage needs to know about a message, loaded once."""
+    __slots__ = ('guild_config', 'channel_config', 'in_thread', 'moderated')
+
+    def __init__(self, message, guild_config: dict, channel_config: dict):
+        self.guild_config = guild_config
+        self.channel_config = channel_config
+        self.in_thread = isinstance(message.channel, discord.Thread)
+        # Members who can manage messages are never moderated
+        self.moderated = (isinstance(message.author, discord.Member)
+                          and not message.channel.permissions_for(message.author).manage_messages)
+
+
+class StageStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0
 
 
 class AutoMod2Settings(CogSettings):
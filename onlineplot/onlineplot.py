@@ -6,13 +6,12 @@ from datetime import datetime, time, tzinfo
 from io import BytesIO
 from typing import List, Optional, Sequence, Tuple
 
-import aioodbc
 import discord
 import matplotlib.pyplot as plt
-import sys
-from aioodbc import Pool
 from redbot.core import Config, checks, commands, data_manager
 
+from .sqlite_engine import SqliteEngine
+
 logger = logging.getLogger('red.misc-cogs.onlineplot')
 
 plt.interactive(False)
@@ -60,7 +59,7 @@ WHERE guild_id = ?
 '''
 
 DELETE_OLD = '''
-DELETE FROM onlineplot WHERE DATE(record_date, "+57 days") < DATE('now')
+DELETE FROM onlineplot WHERE DATE(record_date, '+57 days') < DATE('now')
 '''
 
 DELETE_GUILD = '''
@@ -81,7 +80,7 @@ class OnlinePlot(commands.Cog):
 
         self.db_path = _data_file('log.db')
         self.lock = asyncio.Event()
-        self.pool: Optional[Pool] = None
+        self.db: Optional[SqliteEngine] = None
 
         self.config = Config.get_conf(self, identifier=771739707)
         self.config.register_guild(opted_in=False)
@@ -106,25 +105,23 @@ class OnlinePlot(commands.Cog):
         self._loop.cancel()
         self._refresh_loop.cancel()
         self.lock.clear()
-        if self.pool:
-            self.pool.close()
-            self.bot.loop.create_task(self.pool.wait_closed())
-            self.pool = None
+        if self.db:
+            self.bot.loop.create_task(self.db.close())
+            self.db = None
         else:
-            logger.error('unexpected error: pool was None')
+            logger.error('unexpected error: db was None')
         logger.info('OnlinePlot: unloading complete')
 
     async def init(self):
         logger.info('OnlinePlot: init')
-        if os.name != 'nt' and sys.platform != 'win32':
-            dsn = 'Driver=SQLite3;Database=' + self.db_path
-        else:
-            dsn = 'Driver=SQLite3 ODBC Driver;Database=' + self.db_path
-        self.pool = await aioodbc.create_pool(dsn=dsn, autocommit=True)
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(CREATE_TABLE)
-                await cur.execute(CREATE_INDEX)
+        self.db = SqliteEngine(self.db_path)
+        await self.db.open()
+
+        def create_schema(conn):
+            conn.execute(CREATE_TABLE)
+            conn.execute(CREATE_INDEX)
+
+        await self.db.write(create_schema)
         self.lock.set()
 
         logger.info('OnlinePlot: init complete')
@@ -155,7 +152,7 @@ class OnlinePlot(commands.Cog):
         except asyncio.TimeoutError:
             return await ctx.send("Opt-out cancelled.  Your data was not deleted.")
         else:
-            await self.execute_query(DELETE_GUILD, (ctx.guild.id,))
+            await self.db.execute(DELETE_GUILD, (ctx.guild.id,))
             await self.config.guild(ctx.guild).opted_in.set(False)
             await ctx.send("Data deleted successfully.")
         finally:
@@ -196,7 +193,7 @@ class OnlinePlot(commands.Cog):
         dnd = [row[3] for row in data]
         offline = [row[4] for row in data]
 
-        weekcount = (await self.execute_query(GET_WEEKS, (self.get_tz_str(tz), ctx.guild.id)))[0][0]
+        weekcount = (await self.db.fetchone(GET_WEEKS, (self.get_tz_str(tz), ctx.guild.id)))[0]
 
         await ctx.send(file=await self.make_graph(times, online, idle, dnd, colors=('g', 'y', 'r'),
                                                   title=f"Users Online (Averaged over {weekcount} week(s))"))
@@ -235,10 +232,8 @@ class OnlinePlot(commands.Cog):
         now = datetime.now(tz)
         curtz = now.tzinfo
 
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_AVERAGES, (guild.id, self.get_tz_str(tz), str(weekday)))
-                rows = [[int(v) for v in row] for row in await cur.fetchall()]
+        rows = await self.db.fetchall(GET_AVERAGES, (guild.id, self.get_tz_str(tz), str(weekday)))
+        rows = [[int(v) for v in row] for row in rows]
 
         o = []
         for row in rows:
@@ -256,16 +251,7 @@ class OnlinePlot(commands.Cog):
         online, idle, dnd, offline = self.get_onilne_stats(guild)
         values = (record_time_index, guild_id, online, idle, dnd, offline)
 
-        await self.execute_query(stmt, values)
-
-    async def execute_query(self, query, params=()) -> Optional[List[Tuple]]:
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(query, params)
-                try:
-                    return await cur.fetchall()
-                except Exception as e:
-                    pass
+        await self.db.execute(stmt, values)
 
     @staticmethod
     def get_onilne_stats(guild: discord.Guild) -> Tuple[int, int, int, int]:
@@ -315,7 +301,7 @@ class OnlinePlot(commands.Cog):
                 for guild in self.bot.guilds:
                     if await self.config.guild(guild).opted_in():
                         await self.insert_guild(guild)
-                await self.execute_query(DELETE_OLD)
+                await self.db.execute(DELETE_OLD)
             except asyncio.CancelledError as e:
                 logger.info("Task Cancelled.")
                 break
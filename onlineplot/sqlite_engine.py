@@ -0,0 +1,186 @@
+"""Async access to a SQLite database without ODBC.
+
+All writes are serialized through one dedicated writer thread, each job running in its own
+transaction.  Reads run on a small pool of reader threads with their own connections, which WAL
+mode lets proceed while the writer is busy.
+
+Red installs cogs independently, so sqlactivitylog, seniority and onlineplot each carry a copy of
+this module.  Keep the copies identical.
+"""
+import asyncio
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, Tuple, TypeVar
+
+T = TypeVar('T')
+
+# A schema version and the coroutine function that upgrades the database to it
+Migration = Tuple[int, Callable[['SqliteEngine'], Awaitable[None]]]
+# A name, argument count and implementation of a deterministic SQL function
+Function = Tuple[str, int, Callable]
+
+PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16384',
+    'PRAGMA mmap_size=268435456',
+]
+
+
+class SqliteEngine:
+    def __init__(self, path: str, readers: int = 2, timeout: float = 30, functions: Sequence[Function] = ()):
+        self.path = path
+        self.readers = readers
+        self.timeout = timeout
+        self.functions = functions
+
+        self._loop = None
+        self._jobs = queue.Queue()
+        self._writer = None
+        self._reader_pool = None
+        self._reader_local = threading.local()
+        self._reader_conns = []
+        self._reader_conns_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        for name, num_params, fn in self.functions:
+            conn.create_function(name, num_params, fn, deterministic=True)
+        return conn
+
+    async def open(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        ready = self._loop.create_future()
+        self._writer = threading.Thread(target=self._run_writer, args=(ready,),
+                                        name='sqlite-writer', daemon=True)
+        self._writer.start()
+        await ready
+        self._reader_pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix='sqlite-reader')
+
+    async def close(self) -> None:
+        if self._writer:
+            self._jobs.put(None)
+            await self._loop.run_in_executor(None, self._writer.join)
+            self._writer = None
+        if self._reader_pool:
+            await self._loop.run_in_executor(None, partial(self._reader_pool.shutdown, wait=True))
+            self._reader_pool = None
+            with self._reader_conns_lock:
+                for conn in self._reader_conns:
+                    conn.close()
+                self._reader_conns = []
+
+    def _run_writer(self, ready: asyncio.Future) -> None:
+        try:
+            conn = self._connect()
+        except Exception as ex:
+            self._resolve(ready, exception=ex)
+            return
+        self._resolve(ready)
+
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            fn, future = job
+            try:
+                result = fn(conn)
+            except Exception as ex:
+                self._resolve(future, exception=ex)
+            else:
+                self._resolve(future, result)
+
+        conn.execute('PRAGMA optimize')
+        conn.close()
+
+    def _resolve(self, future: asyncio.Future, result: Any = None, exception: Exception = None) -> None:
+        def set_result():
+            if future.cancelled():
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+        self._loop.call_soon_threadsafe(set_result)
+
+    def _run_reader(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        conn = getattr(self._reader_local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._reader_local.conn = conn
+            with self._reader_conns_lock:
+                self._reader_conns.append(conn)
+        return fn(conn)
+
+    async def write(self, fn: Callable[[sqlite3.Connection], T], transaction: bool = True) -> T:
+        """Run fn(conn) on the writer thread, inside a transaction unless told otherwise."""
+        if transaction:
+            job = partial(_in_transaction, fn)
+        else:
+            job = fn
+        future = self._loop.create_future()
+        self._jobs.put((job, future))
+        return await future
+
+    async def read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """Run fn(conn) on a reader thread."""
+        return await self._loop.run_in_executor(self._reader_pool, self._run_reader, fn)
+
+    async def execute(self, sql: str, params: Sequence = ()) -> int:
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params: Sequence[Sequence]) -> int:
+        return await self.write(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def query(self, sql: str, params: Sequence = ()) -> Tuple[List[str], List[sqlite3.Row]]:
+        """Run a read query, returning the column names and every row."""
+
+        def run(conn):
+            cur = conn.execute(sql, params)
+            return [d[0] for d in cur.description or []], cur.fetchall()
+
+        return await self.read(run)
+
+    async def fetchall(self, sql: str, params: Sequence = ()) -> List[sqlite3.Row]:
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql: str, params: Sequence = ()) -> Optional[sqlite3.Row]:
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def user_version(self) -> int:
+        return (await self.fetchone('PRAGMA user_version'))[0]
+
+    async def migrate(self, migrations: Sequence[Migration]) -> int:
+        """Run every migration newer than the database's user_version, oldest first.
+
+        user_version is bumped after each step completes, so a step interrupted by a restart is run
+        again from the start and must be safe to repeat.  Returns the resulting version.
+        """
+        version = await self.user_version()
+        for target, step in sorted(migrations, key=lambda m: m[0]):
+            if target <= version:
+                continue
+            await step(self)
+            await self.write(lambda conn: conn.execute('PRAGMA user_version = {:d}'.format(target)),
+                             transaction=False)
+            version = target
+        return version
+
+
+def _in_transaction(fn: Callable[[sqlite3.Connection], T], conn: sqlite3.Connection) -> T:
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        result = fn(conn)
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    return result
@@ -0,0 +1,153 @@
+"""Adds or removes roles for many members without tripping Discord's rate limits.
+
+Role changes share a rate limit bucket per guild, so at most a few run at once per guild.  Rate
+limited and server-side failures are retried with exponential backoff; permission and missing
+member errors are not.  Every change gets a RoleResult, so one failure doesn't stop the run, and
+progress is shown in a single message edited in place.
+
+This module only depends on discord.py, so other cogs that mass-assign roles can carry a copy.
+The actual add/remove call is passed in as `mutate`, which lets it be swapped for a fake client.
+"""
+import asyncio
+import logging
+import random
+import timeit
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+import discord
+
+logger = logging.getLogger('red.misc-cogs.seniority.role_scheduler')
+
+# (member, role, add, reason) -> None, raising discord.HTTPException on failure
+Mutate = Callable[[discord.Member, discord.Role, bool, Optional[str]], Awaitable[None]]
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RoleChange(NamedTuple):
+    member: discord.Member
+    role: discord.Role
+    add: bool
+
+
+class RoleResult(NamedTuple):
+    change: RoleChange
+    error: Optional[Exception]
+    attempts: int
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+async def discord_mutate(member: discord.Member, role: discord.Role, add: bool, reason: Optional[str]):
+    if add:
+        await member.add_roles(role, reason=reason)
+    else:
+        await member.remove_roles(role, reason=reason)
+
+
+class ProgressMessage:
+    """A status line that is sent once and then edited, at most once every `interval` seconds."""
+
+    def __init__(self, destination: discord.abc.Messageable, interval: float = 2):
+        self.destination = destination
+        self.interval = interval
+        self.message = None
+        self._text = None
+        self._last_edit = 0
+
+    async def update(self, text: str, force: bool = False):
+        if text == self._text:
+            return
+        now = timeit.default_timer()
+        if self.message is not None and not force and now - self._last_edit < self.interval:
+            return
+        self._text = text
+        self._last_edit = now
+        try:
+            if self.message is None:
+                self.message = await self.destination.send(text)
+            else:
+                await self.message.edit(content=text)
+        except discord.HTTPException:
+            logger.exception('Failed to update progress message')
+
+
+class RoleScheduler:
+    def __init__(self,
+                 mutate: Mutate = discord_mutate,
+                 concurrency: int = 4,
+                 retries: int = 4,
+                 base_delay: float = 1,
+                 max_delay: float = 60):
+        self.mutate = mutate
+        self.concurrency = concurrency
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # guild_id -> semaphore; role changes are rate limited per guild
+        self._buckets: Dict[int, asyncio.Semaphore] = {}
+
+    async def run(self,
+                  changes: Sequence[RoleChange],
+                  progress: Optional[ProgressMessage] = None,
+                  label: str = 'Updating roles',
+                  reason: Optional[str] = None) -> List[RoleResult]:
+        """Apply every change, returning a result for each in the same order."""
+        done = 0
+        failed = 0
+
+        def status():
+            return '{}: {}/{} done, {} failed'.format(label, done, len(changes), failed)
+
+        async def apply(change: RoleChange) -> RoleResult:
+            nonlocal done, failed
+            result = await self._apply(change, reason)
+            done += 1
+            failed += not result.ok
+            if progress:
+                await progress.update(status())
+            return result
+
+        if progress:
+            await progress.update(status(), force=True)
+        results = await asyncio.gather(*[apply(change) for change in changes])
+        if progress:
+            await progress.update(status(), force=True)
+        return results
+
+    async def _apply(self, change: RoleChange, reason: Optional[str]) -> RoleResult:
+        bucket = self._bucket(change.member.guild.id)
+        attempt = 0
+        while True:
+            attempt += 1
+            async with bucket:
+                try:
+                    await self.mutate(change.member, change.role, change.add, reason)
+                    return RoleResult(change, None, attempt)
+                except (discord.HTTPException, asyncio.TimeoutError, OSError) as ex:
+                    if attempt > self.retries or not is_retryable(ex):
+                        return RoleResult(change, ex, attempt)
+                    delay = self.retry_delay(ex, attempt)
+                    # Sleep while holding the slot so a rate limited guild isn't hit harder
+                    logger.info('Retrying role change for %s in %.1fs: %s', change.member.id, delay, ex)
+                    await asyncio.sleep(delay)
+
+    def _bucket(self, guild_id: int) -> asyncio.Semaphore:
+        if guild_id not in self._buckets:
+            self._buckets[guild_id] = asyncio.Semaphore(self.concurrency)
+        return self._buckets[guild_id]
+
+    def retry_delay(self, ex: Exception, attempt: int) -> float:
+        retry_after = getattr(ex, 'retry_after', None)
+        if retry_after:
+            return min(retry_after, self.max_delay)
+        delay = self.base_delay * 2 ** (attempt - 1)
+        return min(delay + random.uniform(0, delay / 2), self.max_delay)
+
+
+def is_retryable(ex: Exception) -> bool:
+    if isinstance(ex, discord.HTTPException):
+        return ex.status in RETRY_STATUSES
+    return True
@@ -1,60 +1,209 @@
+import asyncio
+import csv
+import json
 import logging
 import os
+import random
 import re
-import sys
+import tempfile
 import timeit
-from collections import deque
-from datetime import datetime, timedelta
-from io import BytesIO
+from collections import OrderedDict, defaultdict, deque
+from datetime import date, datetime, timedelta
+from io import BytesIO, TextIOWrapper
+from typing import IO, Dict, List, Optional, Sequence, Tuple
 
-import aioodbc
 import discord
+import numpy as np
 import prettytable
-import pytz
-from redbot.core import checks, commands
+from matplotlib.figure import Figure
+from redbot.core import Config, checks, commands
 from redbot.core.bot import Red
 from redbot.core.commands import Context
+from redbot.core.data_manager import cog_data_path
 from redbot.core.utils.chat_formatting import box, inline, pagify
-from tsutils.cog_settings import CogSettings
+from sortedcontainers import SortedList
 from tsutils.time import DISCORD_DEFAULT_TZ
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .role_scheduler import ProgressMessage, RoleChange, RoleScheduler
+from .row_renderer import RowRenderer
+from .sqlite_engine import SqliteEngine
+
 logger = logging.getLogger('red.misc-cogs.seniority')
 
+# Points are kept in memory by PointsLedger and written back this often, so a crash loses at most
+# this many seconds of points.
+LEDGER_FLUSH_SECONDS = 10
+# Settings changes are written to Config at most this often
+SETTINGS_SAVE_SECONDS = 5
+# Where settings were kept before they moved to Config
+LEGACY_SETTINGS_FILE = 'legacy_settings.json'
+
+# Rows fetched from the cursor at a time while writing an export
+EXPORT_CHUNK_ROWS = 5000
+# Rendered heatmaps kept for reuse until the points behind them change
+HEATMAP_CACHE_SIZE = 32
+
+# Channel histories read at once by catchup
+CATCHUP_CONCURRENCY = 4
+# Command prefixes can be changed outside this cog, so cached filters are rebuilt this often
+FILTER_REFRESH_SECONDS = 60
+
+EMOJI_PATTERN = re.compile(r'<a?:[0-9a-z_]+:\d+>', re.IGNORECASE)
+MENTION_PATTERN = re.compile(r'<@!?\d+>')
+# Eight digits, optionally split in half, that aren't part of a longer number like an emoji id
+ROOM_CODE_PATTERN = re.compile(r'(?<!\d)\d{4}\s?\d{4}(?!\d)')
+
+# Keyed for the lookups the cog makes: a user's channels on a day and a user's days in a server.
+# WITHOUT ROWID and no secondary indexes, so each REPLACE writes one b-tree.
 CREATE_TABLE = '''
-CREATE TABLE IF NOT EXISTS seniority(
-  record_date STRING NOT NULL,
-  server_id STRING NOT NULL,
-  channel_id STRING NOT NULL,
-  user_id STRING NOT NULL,
+CREATE TABLE IF NOT EXISTS {table}(
+  server_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  record_date TEXT NOT NULL,
+  channel_id INTEGER NOT NULL,
   points REAL DEFAULT 0,
-  PRIMARY KEY (record_date, server_id, channel_id, user_id))
+  PRIMARY KEY (server_id, user_id, record_date, channel_id)) WITHOUT ROWID
+'''
+
+# Rebuilds the original table, keyed on (record_date, server_id, channel_id, user_id) with four more
+# indexes, as the layout above.  Dropping the old table drops its indexes.
+MIGRATE_TABLE_QUERIES = [
+    CREATE_TABLE.format(table='seniority_migrating'),
+    '''
+    REPLACE INTO seniority_migrating(server_id, user_id, record_date, channel_id, points)
+    SELECT CAST(server_id AS INTEGER), CAST(user_id AS INTEGER), record_date, CAST(channel_id AS INTEGER), points
+    FROM seniority
+    ''',
+    'DROP TABLE seniority',
+    'ALTER TABLE seniority_migrating RENAME TO seniority',
+]
+
+# Each user's total points per day across channels, kept up to date by PointsLedger.flush() so a
+# lookback reads one range of (server_id, record_date) instead of every channel's rows.
+CREATE_DAILY_TABLE = '''
+CREATE TABLE IF NOT EXISTS seniority_daily(
+  server_id INTEGER NOT NULL,
+  record_date TEXT NOT NULL,
+  user_id INTEGER NOT NULL,
+  points REAL NOT NULL,
+  PRIMARY KEY (server_id, record_date, user_id)) WITHOUT ROWID
 '''
 
-CREATE_INDEX_1 = '''
-CREATE INDEX IF NOT EXISTS idx_server_id_record_date_user_id
-ON seniority(server_id, record_date, user_id)
+REBUILD_DAILY_QUERIES = [
+    'DELETE FROM seniority_daily',
+    '''
+    INSERT INTO seniority_daily(server_id, record_date, user_id, points)
+    SELECT server_id, record_date, user_id, sum(points)
+    FROM seniority
+    GROUP BY 1, 2, 3
+    ''',
+]
+
+# Rows of the raw table's daily sums missing from seniority_daily, and the reverse
+CHECK_DAILY_QUERY = '''
+SELECT 'missing' AS problem, * FROM (
+  SELECT server_id, record_date, user_id, round(sum(points), 6) AS points
+  FROM seniority
+  GROUP BY 1, 2, 3
+  EXCEPT
+  SELECT server_id, record_date, user_id, round(points, 6)
+  FROM seniority_daily)
+UNION ALL
+SELECT 'extra' AS problem, * FROM (
+  SELECT server_id, record_date, user_id, round(points, 6)
+  FROM seniority_daily
+  EXCEPT
+  SELECT server_id, record_date, user_id, round(sum(points), 6)
+  FROM seniority
+  GROUP BY 1, 2, 3)
 '''
 
-# Why?
-CREATE_INDEX_2 = '''
-CREATE INDEX IF NOT EXISTS idx_record_date_server_id_user_id
-ON seniority(record_date, server_id, user_id)
+REPLACE_DAILY_POINTS_QUERY = '''
+REPLACE INTO seniority_daily(server_id, record_date, user_id, points)
+VALUES(?, ?, ?, ?)
+'''
+
+DELETE_USER_DAILY_DATA = '''
+DELETE FROM seniority_daily
+WHERE user_id = ?
 '''
 
-# Why? record date should never come first
-CREATE_INDEX_3 = '''
-CREATE INDEX IF NOT EXISTS idx_record_date_server_id_channel_id_user_id
-ON seniority(record_date, server_id, channel_id, user_id)
+# The last message counted by catchup in each channel, written together with its points
+CREATE_CATCHUP_TABLE = '''
+CREATE TABLE IF NOT EXISTS seniority_catchup(
+  channel_id INTEGER PRIMARY KEY,
+  message_id INTEGER NOT NULL)
 '''
 
-CREATE_INDEX_4 = '''
-CREATE INDEX IF NOT EXISTS idx_server_id_user_id_record_date
-ON seniority(server_id, user_id, record_date)
+GET_CATCHUP_CHECKPOINT_QUERY = '''
+SELECT message_id
+FROM seniority_catchup
+WHERE channel_id = ?
+'''
+
+REPLACE_CATCHUP_CHECKPOINT_QUERY = '''
+REPLACE INTO seniority_catchup(channel_id, message_id)
+VALUES(?, ?)
+'''
+
+GET_DAILY_WINDOW_QUERY = '''
+SELECT user_id, record_date, points
+FROM seniority_daily
+WHERE server_id = ?
+  AND record_date >= ?
+'''
+
+EXPORT_USER_QUERY = '''
+SELECT record_date, channel_id, points
+FROM seniority
+WHERE server_id = ?
+  AND user_id = ?
+  AND record_date >= ?
+ORDER BY record_date, channel_id
+'''
+
+EXPORT_SERVER_QUERY = '''
+SELECT record_date, user_id, points
+FROM seniority_daily
+WHERE server_id = ?
+  AND record_date >= ?
+ORDER BY record_date, user_id
+'''
+
+# Column types of the exports, for parquet
+EXPORT_TYPES = {
+    'record_date': 'string',
+    'channel_id': 'int64',
+    'user_id': 'int64',
+    'points': 'float64',
+}
+
+HEATMAP_USER_QUERY = '''
+SELECT record_date, sum(points) AS points
+FROM seniority
+WHERE server_id = ?
+  AND user_id = ?
+  AND record_date >= ?
+GROUP BY 1
+'''
+
+HEATMAP_SERVER_QUERY = '''
+SELECT record_date, sum(points) AS points
+FROM seniority_daily
+WHERE server_id = ?
+  AND record_date >= ?
+GROUP BY 1
 '''
 
 GET_USER_POINTS_QUERY = '''
 SELECT record_date, round(sum(points), 2) as points
-FROM seniority INDEXED BY idx_server_id_user_id_record_date
+FROM seniority
 WHERE server_id = ?
   AND user_id = ?
 GROUP BY 1
@@ -64,7 +213,7 @@ LIMIT ?
 
 GET_LOOKBACK_POINTS_QUERY = '''
 SELECT user_id, sum(points) as points
-FROM seniority INDEXED BY idx_server_id_user_id_record_date
+FROM seniority_daily
 WHERE server_id = ?
   AND record_date >= ?
 GROUP BY 1
@@ -72,24 +221,7 @@ GROUP BY 1
 
 GET_DATE_POINTS_QUERY = '''
 SELECT channel_id, points
-FROM seniority INDEXED BY idx_server_id_record_date_user_id
-WHERE record_date = ?
-  AND server_id = ?
-  AND user_id = ?
-'''
-
-GET_NEWMESSAGE_POINTS_QUERY = '''
-SELECT SUM(points) as points
-FROM seniority INDEXED BY idx_record_date_server_id_channel_id_user_id
-WHERE record_date = ?
-  AND server_id = ?
-  AND channel_id = ?
-  AND user_id = ?
-'''
-
-GET_NEWMESSAGE_SERVER_POINTS_QUERY = '''
-SELECT SUM(points) as points
-FROM seniority INDEXED BY idx_record_date_server_id_user_id
+FROM seniority
 WHERE record_date = ?
   AND server_id = ?
   AND user_id = ?
@@ -100,22 +232,53 @@ REPLACE INTO seniority(record_date, server_id, channel_id, user_id, points)
 VALUES(?, ?, ?, ?, ?)
 '''
 
-DELETE_DAY_QUERY = '''
-DELETE FROM seniority
-WHERE record_date = ?
-  AND server_id = ?
-'''
-
 DELETE_USER_DATA = '''
 DELETE FROM seniority
 WHERE user_id = ?
 '''
 
 GET_USER_DATA = '''
-SELECT * FROM seniority
+SELECT COUNT(DISTINCT server_id) FROM seniority
 WHERE user_id = ?
 '''
 
+# Every query the cog runs and which costly plan steps it is allowed: 'scan' for reading a whole
+# table, 'sort' for a temp b-tree.
+PLANNED_QUERIES = [
+    ('date points', GET_DATE_POINTS_QUERY, ()),
+    ('replace points', REPLACE_POINTS_QUERY, ()),
+    ('user points', GET_USER_POINTS_QUERY, ()),
+    ('lookback points', GET_LOOKBACK_POINTS_QUERY, ('sort',)),
+    ('daily window', GET_DAILY_WINDOW_QUERY, ()),
+    ('replace daily', REPLACE_DAILY_POINTS_QUERY, ()),
+    ('catchup checkpoint', GET_CATCHUP_CHECKPOINT_QUERY, ()),
+    ('replace checkpoint', REPLACE_CATCHUP_CHECKPOINT_QUERY, ()),
+    ('export user', EXPORT_USER_QUERY, ()),
+    ('export server', EXPORT_SERVER_QUERY, ()),
+    ('heatmap user', HEATMAP_USER_QUERY, ()),
+    ('heatmap server', HEATMAP_SERVER_QUERY, ()),
+    # Owner commands and data requests, rare enough to read everything
+    ('user data', GET_USER_DATA, ('scan',)),
+    ('delete user data', DELETE_USER_DATA, ('scan',)),
+    ('delete user daily data', DELETE_USER_DAILY_DATA, ('scan',)),
+    ('rebuild daily', REBUILD_DAILY_QUERIES[1], ('scan', 'sort')),
+    ('check daily', CHECK_DAILY_QUERY, ('scan', 'sort')),
+]
+
+# Secondary indexes per table.  Each one is another b-tree written by every REPLACE.
+EXPECTED_INDEXES = {
+    'seniority': 0,
+    'seniority_daily': 0,
+    'seniority_catchup': 0,
+}
+
+GET_INDEXES_QUERY = '''
+SELECT name FROM sqlite_master
+WHERE type = 'index'
+  AND tbl_name = ?
+  AND sql IS NOT NULL
+'''
+
 
 class Seniority(commands.Cog):
     """Automatically promote people based on activity."""
@@ -123,57 +286,101 @@ class Seniority(commands.Cog):
     def __init__(self, bot: Red, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.bot = bot
-        self.settings = SenioritySettings("seniority")
-        self.db_path = self.settings.folder + '/log.db'
+        self.config = Config.get_conf(self, identifier=7365432)
+        self.config.register_global(legacy_settings_migrated=False)
+        self.config.register_guild(**GuildSettings().to_dict())
+        self.settings = SenioritySettings(bot, self.config)
+        self.db_path = str(cog_data_path(raw_name='seniority')) + '/log.db'
         self.lock = True
-        self.pool = None
+        self.db = None
+        self.ledger = None
+        self._flush_loop = None
         self.insert_timing = deque(maxlen=1000)
+        self.role_scheduler = RoleScheduler()
+        # server_id -> AcceptabilityFilter
+        self.filters = {}
+        # (server_id, days) -> RankIndex
+        self.rank_indexes = {}
+        # (server_id, user_id or None) -> count of point changes, to tell when a heatmap is stale
+        self.points_versions = defaultdict(int)
+        # (server_id, user_id or None, days) -> ((date, version), png)
+        self.heatmaps = OrderedDict()
 
     async def red_get_data_for_user(self, *, user_id):
         """Get a user's personal data."""
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_USER_DATA, user_id)
-                rows = await cur.fetchall()
-        guilds = len({r[1] for r in rows})
+        guilds = (await self.db.fetchone(GET_USER_DATA, [user_id]))[0]
         data = "You have activity data stored in {} guilds.\n".format(guilds)
         return {"user_data.txt": BytesIO(data.encode())}
 
     async def red_delete_data_for_user(self, *, requester, user_id):
         """Delete a user's personal data."""
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(DELETE_USER_DATA, user_id)
+        self.ledger.forget_user(user_id)
+        for index in self.rank_indexes.values():
+            index.forget_user(user_id)
+        self.heatmaps.clear()
+
+        def delete(conn):
+            conn.execute(DELETE_USER_DATA, [user_id])
+            conn.execute(DELETE_USER_DAILY_DATA, [user_id])
+
+        await self.db.write(delete)
 
     def cog_unload(self):
         logger.debug('Seniority: unloading')
         self.lock = True
-        if self.pool:
-            self.pool.close()
-            self.bot.loop.create_task(self.pool.wait_closed())
-            self.pool = None
+        if self._flush_loop:
+            self._flush_loop.cancel()
+        self.bot.loop.create_task(self.settings.close())
+        if self.db:
+            self.bot.loop.create_task(self.flush_and_close())
         else:
-            logger.error('unexpected error: pool was None')
+            logger.error('unexpected error: db was None')
         logger.debug('Seniority: unloading complete')
 
+    async def flush_and_close(self):
+        try:
+            await self.flush_points()
+        finally:
+            await self.db.close()
+            self.db = None
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(LEDGER_FLUSH_SECONDS)
+            try:
+                await self.flush_points()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Failed to write seniority points')
+
+    async def flush_points(self):
+        before_time = timeit.default_timer()
+        rows = await self.ledger.flush()
+        if rows:
+            self.insert_timing.append((rows, timeit.default_timer() - before_time))
+
     async def init(self):
         logger.debug('Seniority: init')
         if not self.lock:
             logger.info('Seniority: bailing on unlock')
             return
 
-        if os.name != 'nt' and sys.platform != 'win32':
-            dsn = 'Driver=SQLite3;Database=' + self.db_path
-        else:
-            dsn = 'Driver=SQLite3 ODBC Driver;Database=' + self.db_path
-        self.pool = await aioodbc.create_pool(dsn=dsn, autocommit=True)
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(CREATE_TABLE)
-                await cur.execute(CREATE_INDEX_1)
-                await cur.execute(CREATE_INDEX_2)
-                await cur.execute(CREATE_INDEX_3)
-                await cur.execute(CREATE_INDEX_4)
+        await self.settings.load()
+        self.db = SqliteEngine(self.db_path)
+        await self.db.open()
+
+        def create_schema(conn):
+            conn.execute(CREATE_TABLE.format(table='seniority'))
+
+        await self.db.write(create_schema)
+        await self.db.migrate([
+            (1, self.create_daily_table),
+            (2, lambda db: db.execute(CREATE_CATCHUP_TABLE)),
+            (3, lambda db: db.write(migrate_table)),
+        ])
+        self.ledger = PointsLedger(self.db)
+        self._flush_loop = self.bot.loop.create_task(self.flush_loop())
         self.lock = False
 
         logger.debug('Seniority: init complete')
@@ -193,10 +400,71 @@ class Seniority(commands.Cog):
     @checks.is_owner()
     async def inserttiming(self, ctx):
         size = len(self.insert_timing)
-        avg_time = round(sum(self.insert_timing) / size, 4)
-        max_time = round(max(self.insert_timing), 4)
-        min_time = round(min(self.insert_timing), 4)
-        await ctx.send(inline('{} inserts, min={} max={} avg={}'.format(size, min_time, max_time, avg_time)))
+        if not size:
+            await ctx.send(inline('No points written yet, {} pending'.format(len(self.ledger.dirty))))
+            return
+        batch_times = [t for _, t in self.insert_timing]
+        row_count = sum(c for c, _ in self.insert_timing)
+        avg_time = round(sum(batch_times) / size, 4)
+        max_time = round(max(batch_times), 4)
+        min_time = round(min(batch_times), 4)
+        await ctx.send(inline('{} flushes ({} rows, {} pending), min={} max={} avg={}'.format(
+            size, row_count, len(self.ledger.dirty), min_time, max_time, avg_time)))
+
+    async def create_daily_table(self, db: SqliteEngine):
+        def create(conn):
+            conn.execute(CREATE_DAILY_TABLE)
+            rebuild_daily_table(conn)
+
+        await db.write(create)
+
+    @seniority.command()
+    @checks.is_owner()
+    async def rebuilddaily(self, ctx):
+        """Recompute the per-user daily totals from the per-channel points."""
+        await self.flush_points()
+        before_time = timeit.default_timer()
+        rows = await self.db.write(rebuild_daily_table)
+        self.rank_indexes.clear()
+        execution_time = timeit.default_timer() - before_time
+        await ctx.send(inline('Rebuilt {} daily totals in {}s'.format(rows, round(execution_time, 2))))
+
+    @seniority.command()
+    @checks.is_owner()
+    async def queryplans(self, ctx):
+        """Check every query's plan and each table's indexes against what the cog expects."""
+        lines = await self.db.read(check_schema)
+        for page in pagify('\n'.join(lines)):
+            await ctx.send(box(page))
+
+    @seniority.command()
+    @checks.is_owner()
+    async def checkdaily(self, ctx):
+        """Compare the per-user daily totals against the per-channel points."""
+        await self.flush_points()
+        rows = await self.db.fetchall(CHECK_DAILY_QUERY)
+        if not rows:
+            await ctx.send(inline('Daily totals match'))
+            return
+        await ctx.send(inline('{} daily totals differ, showing the first 50'.format(len(rows))))
+        await self.queryAndPrint(ctx, ctx.guild, CHECK_DAILY_QUERY + ' LIMIT 50', [])
+
+    @seniority.command()
+    @checks.is_owner()
+    async def acceptablebench(self, ctx, messages: int = 10000):
+        """Time this server's acceptability filter on a synthetic mix of messages."""
+        messages = max(1, min(messages, 1000000))
+        acceptability_filter = await self.acceptability_filter(ctx.guild)
+        prefix = (acceptability_filter.prefixes or (ctx.clean_prefix,))[0]
+        results = benchmark_filter(acceptability_filter, synthetic_messages(messages, prefix))
+
+        tbl = prettytable.PrettyTable(['Kind', 'Messages', 'Accepted', 'us/msg'])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for kind, count, accepted, seconds in results:
+            tbl.add_row([kind, count, accepted, round(seconds / count * 10 ** 6, 2)])
+        await ctx.send(box(tbl.get_string()))
 
     @seniority.command()
     @checks.is_owner()
@@ -296,27 +564,18 @@ class Seniority(commands.Cog):
         """List users above the grant amount."""
         guild = ctx.guild
         lookback_days = self.settings.grant_lookback(guild.id)
-        for role_id, role, amount in self.roles_and_amounts(guild, 'grant_amount'):
+        roles_and_amounts = list(self.roles_and_amounts(guild, 'grant_amount'))
+        snapshot = await self.lookback_snapshot(guild, lookback_days, roles_and_amounts)
+        for role_id, role, amount in roles_and_amounts:
             if role is None or amount <= 0:
                 continue
 
-            msg = 'Granting for role {} (point cutoff {})'.format(role.name, amount)
-            await ctx.send(inline(msg))
-
-            grant_users, ignored_users = await self.get_grant_ignore_users(
-                guild, role, amount, lookback_days, True)
-            grant_users = [guild.get_member(int(x[0])) for x in grant_users]
-
-            cs = 5
-            user_chunks = [grant_users[i:i + cs] for i in range(0, len(grant_users), cs)]
-            for chunk in user_chunks:
-                msg = 'Granting to users: ' + ','.join([m.name for m in chunk])
-                await ctx.send(inline(msg))
-                for member in chunk:
-                    try:
-                        await member.add_roles(role)
-                    except Exception as ex:
-                        raise commands.UserFeedbackCheckFailure(str(ex))
+            grant_users, ignored_users = snapshot.users_for_role(role, amount, True)
+            # Members who left since the snapshot have nothing to change
+            members = [guild.get_member(user_id) for user_id, _ in grant_users]
+            changes = [RoleChange(member, role, True) for member in members if member is not None]
+            label = 'Granting role {} (point cutoff {})'.format(role.name, amount)
+            await self.change_roles(ctx, changes, label)
 
     @grant.command()
     @commands.guild_only()
@@ -324,27 +583,27 @@ class Seniority(commands.Cog):
         """List users below the remove amount."""
         server = ctx.guild
         lookback_days = self.settings.remove_lookback(server.id)
-        for role_id, role, amount in self.roles_and_amounts(server, 'remove_amount'):
+        roles_and_amounts = list(self.roles_and_amounts(server, 'remove_amount'))
+        snapshot = await self.lookback_snapshot(server, lookback_days, roles_and_amounts)
+        for role_id, role, amount in roles_and_amounts:
             if role is None or amount <= 0:
                 continue
 
-            msg = 'Removing for role {} (point cutoff {})'.format(role.name, amount)
-            await ctx.send(inline(msg))
-
-            grant_users, ignored_users = await self.get_grant_ignore_users(
-                server, role, amount, lookback_days, False)
-            grant_users = [server.get_member(int(x[0])) for x in grant_users]
-
-            cs = 5
-            user_chunks = [grant_users[i:i + cs] for i in range(0, len(grant_users), cs)]
-            for chunk in user_chunks:
-                msg = 'Removing from users: ' + ','.join([m.name for m in chunk])
-                await ctx.send(inline(msg))
-                for member in chunk:
-                    try:
-                        await member.remove_roles(role)
-                    except Exception as ex:
-                        raise commands.UserFeedbackCheckFailure(str(ex))
+            remove_users, ignored_users = snapshot.users_for_role(role, amount, False)
+            members = [server.get_member(user_id) for user_id, _ in remove_users]
+            changes = [RoleChange(member, role, False) for member in members if member is not None]
+            label = 'Removing role {} (point cutoff {})'.format(role.name, amount)
+            await self.change_roles(ctx, changes, label)
+
+    async def change_roles(self, ctx: Context, changes, label: str):
+        """Apply role changes with a single progress message, then list any that failed."""
+        results = await self.role_scheduler.run(changes, ProgressMessage(ctx), label, reason='Seniority')
+        failures = ['{} ({}): {}'.format(r.change.member.name, r.change.member.id, r.error)
+                    for r in results if not r.ok]
+        if failures:
+            msg = 'Failed for {} users\n'.format(len(failures)) + '\n'.join(failures)
+            for page in pagify(msg):
+                await ctx.send(box(page))
 
     async def do_print_overages(self,
                                 ctx: Context,
@@ -354,17 +613,18 @@ class Seniority(commands.Cog):
                                 points_greater_than: bool):
         await ctx.send(inline('Displaying info for all roles'))
 
-        for role_id, role, amount in self.roles_and_amounts(server, check_name):
+        roles_and_amounts = list(self.roles_and_amounts(server, check_name))
+        snapshot = await self.lookback_snapshot(server, lookback_days, roles_and_amounts)
+        for role_id, role, amount in roles_and_amounts:
             if role is None:
-                await ctx.send(inline('Cannot find role with id ' + role_id))
+                await ctx.send(inline('Cannot find role with id {}'.format(role_id)))
                 continue
 
             if amount <= 0:
                 await ctx.send(inline('Skipping role {} (disabled)'.format(role.name)))
                 continue
 
-            grant_users, ignored_users = await self.get_grant_ignore_users(
-                server, role, amount, lookback_days, points_greater_than)
+            grant_users, ignored_users = snapshot.users_for_role(role, amount, points_greater_than)
 
             def process_userlist(user_list):
                 r = ''
@@ -389,63 +649,20 @@ class Seniority(commands.Cog):
             role = server.get_role(role_id)
             yield role_id, role, role_config[check_name]
 
-    async def get_grant_ignore_users(self,
-                                     server: discord.Guild,
-                                     role: discord.Role,
-                                     amount: int,
-                                     lookback_days: int,
-                                     points_greater_than: bool):
-
-        if points_greater_than:
-            def point_check_fn(p):
-                return p >= amount
-        else:
-            def point_check_fn(p):
-                return p < amount
-
+    async def lookback_snapshot(self, server: discord.Guild, lookback_days: int, roles_and_amounts):
+        """Points and role membership for every member, shared by all the roles being checked."""
         users_and_points = await self.get_lookback_points(server, lookback_days)
-        grant_users, ignored_users = self.check_users_for_role(
-            users_and_points, server, point_check_fn, role, points_greater_than)
-
-        return grant_users, ignored_users
+        role_ids = [role.id for _, role, _ in roles_and_amounts if role is not None]
+        blacklisted_ids = self.settings.blacklist(server.id).keys()
+        return LookbackSnapshot(server.members, users_and_points, role_ids, blacklisted_ids)
 
     async def get_lookback_points(self, server: discord.Guild, lookback_days: int):
         lookback_date = datetime.now(DISCORD_DEFAULT_TZ) - timedelta(days=lookback_days)
         lookback_date_str = lookback_date.date().isoformat()
 
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_LOOKBACK_POINTS_QUERY, server.id, lookback_date_str)
-                rows = await cur.fetchall()
-                return [(int(x[0]), x[1]) for x in rows]
-
-    def check_users_for_role(self,
-                             users_and_points,
-                             server: discord.Guild,
-                             point_check_fn,
-                             role: discord.Role,
-                             adding_role: bool):
-        blacklisted_ids = self.settings.blacklist(server.id).keys()
-
-        grant_users = []
-        ignored_users = []
-
-        userid_to_points = {x[0]: x[1] for x in users_and_points}
-        for user in server.members:
-            points = userid_to_points.get(user.id, 0)
-            if role in user.roles and adding_role:
-                continue
-            if role not in user.roles and not adding_role:
-                continue
-            if not point_check_fn(points):
-                continue
-
-            if user.id in blacklisted_ids:
-                ignored_users.append((user.id, points))
-            else:
-                grant_users.append((user.id, points))
-
-        return grant_users, ignored_users
+        await self.flush_points()
+        rows = await self.db.fetchall(GET_LOOKBACK_POINTS_QUERY, [server.id, lookback_date_str])
+        return [(int(x[0]), x[1]) for x in rows]
 
     @seniority.command()
     @commands.guild_only()
@@ -456,6 +673,71 @@ class Seniority(commands.Cog):
         args = [server.id, user.id, limit]
         await self.queryAndPrint(ctx, server, GET_USER_POINTS_QUERY, args, reverse=True, total=True)
 
+    @seniority.command()
+    @commands.guild_only()
+    async def export(self, ctx, user: Optional[discord.User] = None, days: int = 365, file_format: str = 'csv'):
+        """Export daily points as csv or parquet.
+
+        With a user, exports their points per day and channel.  Otherwise exports every user's
+        points per day.
+        """
+        server = ctx.guild
+        file_format = file_format.lower()
+        if file_format not in ('csv', 'parquet'):
+            raise commands.UserFeedbackCheckFailure('Format must be csv or parquet')
+        if file_format == 'parquet' and pyarrow is None:
+            raise commands.UserFeedbackCheckFailure('Parquet export needs pyarrow installed')
+
+        cutoff = (datetime.now(DISCORD_DEFAULT_TZ) - timedelta(days=days)).date().isoformat()
+        if user:
+            query, args, name = EXPORT_USER_QUERY, [server.id, user.id, cutoff], 'seniority_{}'.format(user.id)
+        else:
+            query, args, name = EXPORT_SERVER_QUERY, [server.id, cutoff], 'seniority_{}'.format(server.id)
+
+        await self.flush_points()
+        before_time = timeit.default_timer()
+        out, rows = await self.db.read(lambda conn: export_rows(conn, query, args, file_format))
+        execution_time = timeit.default_timer() - before_time
+        msg = '{} rows exported in {}s'.format(rows, round(execution_time, 2))
+        await ctx.send(inline(msg), file=discord.File(out, '{}.{}'.format(name, file_format)))
+
+    @seniority.command()
+    @commands.guild_only()
+    async def heatmap(self, ctx, user: Optional[discord.User] = None, days: int = 365):
+        """Show points per day as a calendar, for a user or the whole server."""
+        days = max(7, min(days, 3 * 365))
+        png = await self.get_heatmap(ctx.guild, user, days)
+        await ctx.send(file=discord.File(BytesIO(png), 'heatmap.png'))
+
+    async def get_heatmap(self, server: discord.Guild, user: Optional[discord.User], days: int) -> bytes:
+        """A rendered heatmap, reused until the day changes or the points behind it do."""
+        user_id = user.id if user else None
+        key = (server.id, user_id, days)
+        stamp = (now_date(), self.points_versions[(server.id, user_id)])
+        cached = self.heatmaps.get(key)
+        if cached and cached[0] == stamp:
+            self.heatmaps.move_to_end(key)
+            return cached[1]
+
+        end = datetime.now(DISCORD_DEFAULT_TZ).date()
+        start = end - timedelta(days=days)
+        await self.flush_points()
+        if user:
+            rows = await self.db.fetchall(HEATMAP_USER_QUERY, [server.id, user.id, start.isoformat()])
+            title = 'Points per day for {}'.format(user.name)
+        else:
+            rows = await self.db.fetchall(HEATMAP_SERVER_QUERY, [server.id, start.isoformat()])
+            title = 'Points per day in {}'.format(server.name)
+        day_points = [(row['record_date'], row['points']) for row in rows]
+        # Figure without pyplot keeps no global state, so rendering is safe on an executor thread
+        png = await self.bot.loop.run_in_executor(None, render_heatmap, day_points, start, end, title)
+
+        self.heatmaps[key] = (stamp, png)
+        self.heatmaps.move_to_end(key)
+        while len(self.heatmaps) > HEATMAP_CACHE_SIZE:
+            self.heatmaps.popitem(last=False)
+        return png
+
     @seniority.command()
     @commands.guild_only()
     async def usercurrent(self, ctx, user: discord.User):
@@ -613,6 +895,7 @@ class Seniority(commands.Cog):
         server_id = ctx.guild.id
         new_setting = not self.settings.ignore_commands(server_id)
         self.settings.set_ignore_commands(server_id, new_setting)
+        self.filters.pop(server_id, None)
         await ctx.send(inline('ignore_commands set to {}.'.format(new_setting)))
 
     @acceptable.command()
@@ -622,6 +905,7 @@ class Seniority(commands.Cog):
         server_id = ctx.guild.id
         new_setting = not self.settings.ignore_emoji(server_id)
         self.settings.set_ignore_emoji(server_id, new_setting)
+        self.filters.pop(server_id, None)
         await ctx.send(inline('ignore_emoji set to {}.'.format(new_setting)))
 
     @acceptable.command()
@@ -631,6 +915,7 @@ class Seniority(commands.Cog):
         server_id = ctx.guild.id
         new_setting = not self.settings.ignore_mentions(server_id)
         self.settings.set_ignore_mentions(server_id, new_setting)
+        self.filters.pop(server_id, None)
         await ctx.send(inline('ignore_mentions set to {}.'.format(new_setting)))
 
     @acceptable.command()
@@ -640,6 +925,7 @@ class Seniority(commands.Cog):
         server_id = ctx.guild.id
         new_setting = not self.settings.ignore_room_codes(server_id)
         self.settings.set_ignore_room_codes(server_id, new_setting)
+        self.filters.pop(server_id, None)
         await ctx.send(inline('ignore_room_codes set to {}.'.format(new_setting)))
 
     @acceptable.command()
@@ -648,6 +934,7 @@ class Seniority(commands.Cog):
         """Set the minimum length of text."""
         server_id = ctx.guild.id
         self.settings.set_min_length(server_id, length)
+        self.filters.pop(server_id, None)
         await ctx.send(inline('Min text length set to {}.'.format(length)))
 
     @acceptable.command()
@@ -656,32 +943,19 @@ class Seniority(commands.Cog):
         """Set the minimum number of words in text."""
         server_id = ctx.guild.id
         self.settings.set_min_words(server_id, words)
+        self.filters.pop(server_id, None)
         await ctx.send(inline('Min word count set to {}.'.format(words)))
 
     async def check_acceptable(self, message: discord.Message, text: str):
-        server = message.guild
-        server_id = server.id
-        if self.settings.ignore_commands(server_id):
-            if (await self.bot.get_context(message)).prefix:  # noqa ????
-                return False, text, 'Ignored command'
-
-        if self.settings.ignore_room_codes(server_id):
-            if re.match(r'.*\d{4}\s?\d{4}.*', text):
-                return False, text, 'Ignored room code'
-
-        if self.settings.ignore_emoji(server_id):
-            text = re.sub(r'<:[0-9a-z_]+:\d{18}>', '', text, re.IGNORECASE)
+        return (await self.acceptability_filter(message.guild)).check(text)
 
-        if self.settings.ignore_mentions(server_id):
-            text = re.sub(r'<@\d{18}>', '', text, re.IGNORECASE)
-
-        if len(text) < self.settings.min_length(server_id):
-            return False, text, 'Min length'
-
-        if len(text.split()) < self.settings.min_words(server_id):
-            return False, text, 'Min words'
-
-        return True, text, 'Passed!'
+    async def acceptability_filter(self, server: discord.Guild) -> 'AcceptabilityFilter':
+        acceptability_filter = self.filters.get(server.id)
+        if acceptability_filter is None or acceptability_filter.age() > FILTER_REFRESH_SECONDS:
+            prefixes = await self.bot.get_valid_prefixes(server)
+            acceptability_filter = AcceptabilityFilter(self.settings, server.id, prefixes)
+            self.filters[server.id] = acceptability_filter
+        return acceptability_filter
 
     @commands.Cog.listener("on_message")
     async def on_message(self, message: discord.Message):
@@ -693,15 +967,63 @@ class Seniority(commands.Cog):
     @seniority.command()
     @commands.guild_only()
     async def catchup(self, ctx, days_ago_start: int, days_ago_end: int = 0):
-        """Catchup messages from `days_ago_start` days ago to `days_ago_end` days ago"""
-        for cid in self.settings.channels(ctx.guild.id):
-            channel = self.bot.get_channel(cid)
-            if channel is None:
-                continue
-            async for m in channel.history(after=datetime.utcnow()-timedelta(days=days_ago_start), 
-                                           before=datetime.utcnow()-timedelta(days=days_ago_end)):
-                await self.process_message(m, m.created_at.date().isoformat())
-        await ctx.tick()
+        """Catchup messages from `days_ago_start` days ago to `days_ago_end` days ago
+
+        The last message counted in each channel is saved, so running the same catchup again
+        resumes where it stopped instead of counting messages twice.
+        """
+        if self.lock:
+            await ctx.send(inline('Seniority is locked, unlock it before catching up'))
+            return
+
+        now = discord.utils.utcnow()
+        start_id = discord.utils.time_snowflake(now - timedelta(days=days_ago_start))
+        end_id = discord.utils.time_snowflake(now - timedelta(days=days_ago_end))
+        channels = [self.bot.get_channel(cid) for cid in self.settings.channels(ctx.guild.id)]
+        channels = [c for c in channels if c is not None]
+
+        progress = ProgressMessage(ctx)
+        semaphore = asyncio.Semaphore(CATCHUP_CONCURRENCY)
+        before_time = timeit.default_timer()
+        messages = 0
+        channels_done = 0
+
+        def status():
+            elapsed = timeit.default_timer() - before_time
+            return 'Catchup: {} messages ({} msgs/sec), {}/{} channels done'.format(
+                messages, round(messages / elapsed if elapsed else 0, 1), channels_done, len(channels))
+
+        async def catchup_channel(channel):
+            nonlocal messages, channels_done
+            async with semaphore:
+                row = await self.db.fetchone(GET_CATCHUP_CHECKPOINT_QUERY, [channel.id])
+                after_id = row[0] if row and start_id < row[0] < end_id else start_id
+                async for m in channel.history(limit=None, after=discord.Object(after_id),
+                                               before=discord.Object(end_id), oldest_first=True):
+                    # process_message skips messages while locked, and the checkpoint mustn't pass them
+                    if self.lock:
+                        raise RuntimeError('Seniority was locked during catchup')
+                    await self.process_message(m, m.created_at.date().isoformat())
+                    self.ledger.set_checkpoint(channel.id, m.id)
+                    messages += 1
+                    await progress.update(status())
+            channels_done += 1
+            await progress.update(status())
+
+        results = await asyncio.gather(*[catchup_channel(channel) for channel in channels],
+                                       return_exceptions=True)
+        await self.flush_points()
+        await progress.update(status(), force=True)
+
+        failed = [(channel, ex) for channel, ex in zip(channels, results) if isinstance(ex, Exception)]
+        for channel, ex in failed:
+            logger.error('Catchup failed for channel %s', channel.id, exc_info=ex)
+        if failed:
+            msg = 'Catchup stopped early in {}, run it again to resume'.format(
+                ', '.join(channel.name for channel, _ in failed))
+            await ctx.send(inline(msg))
+        else:
+            await ctx.tick()
 
     async def process_message(self, message: discord.Message, now_date_str: str):
         if self.lock:
@@ -714,7 +1036,8 @@ class Seniority(commands.Cog):
         if guild is None or message.author.id == self.bot.user.id:
             return
 
-        channel_config = self.settings.channels(guild.id).get(channel.id, None)
+        guild_settings = self.settings.guilds.get(guild.id)
+        channel_config = guild_settings and guild_settings.channels.get(channel.id)
         if not channel_config:
             return
 
@@ -729,53 +1052,111 @@ class Seniority(commands.Cog):
         if current_points >= max_points:
             return
 
-        server_point_cap = self.settings.server_point_cap(guild.id)
+        server_point_cap = guild_settings.server_point_cap
         current_server_points = await self.get_current_server_points(now_date_str, guild, user)
         current_server_points = current_server_points or 0
 
         if current_server_points >= server_point_cap:
             return
 
-        message_cap = self.settings.message_cap(guild.id)
+        message_cap = guild_settings.message_cap
         incremental_points = max_points / message_cap
         new_points = current_points + incremental_points
         new_points = min(new_points, max_points)
 
-        before_time = timeit.default_timer()
-        await self.save_current_points(now_date_str, guild, channel, user, new_points)
-        execution_time = timeit.default_timer() - before_time
-        self.insert_timing.append(execution_time)
+        self.save_current_points(now_date_str, guild, channel, user, new_points)
 
         return incremental_points
 
     async def get_current_channel_points(self, now_date_str: str, server: discord.Guild, channel: discord.TextChannel,
                                          user: discord.User):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_NEWMESSAGE_POINTS_QUERY, now_date_str, server.id, channel.id, user.id)
-                results = await cur.fetchone()
-                return results.points if results else 0
+        await self.ledger.load(now_date_str, server.id, user.id)
+        return self.ledger.channel_points(now_date_str, server.id, channel.id, user.id)
 
     async def get_current_server_points(self, now_date_str: str, server: discord.Guild, user: discord.User):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_NEWMESSAGE_SERVER_POINTS_QUERY, now_date_str, server.id, user.id)
-                results = await cur.fetchone()
-                return results.points if results else 0
-
-    async def save_current_points(self, now_date_str: str, server: discord.Guild, channel: discord.TextChannel,
-                                  user: discord.User, new_points: int):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(REPLACE_POINTS_QUERY, now_date_str, server.id, channel.id, user.id, new_points)
+        await self.ledger.load(now_date_str, server.id, user.id)
+        return self.ledger.server_points(now_date_str, server.id, user.id)
+
+    def save_current_points(self, now_date_str: str, server: discord.Guild, channel: discord.TextChannel,
+                            user: discord.User, new_points: float):
+        old_total = self.ledger.server_points(now_date_str, server.id, user.id)
+        self.ledger.set_points(now_date_str, server.id, channel.id, user.id, new_points)
+        new_total = self.ledger.server_points(now_date_str, server.id, user.id)
+        self.points_versions[(server.id, None)] += 1
+        self.points_versions[(server.id, user.id)] += 1
+        for (server_id, _), index in self.rank_indexes.items():
+            if server_id == server.id:
+                index.update(user.id, now_date_str, new_total, new_total - old_total)
+
+    async def rank_index(self, server_id: int, days: int) -> 'RankIndex':
+        """The server's users ranked by points over the last `days` days, loaded on first use."""
+        cutoff = (datetime.now(DISCORD_DEFAULT_TZ) - timedelta(days=days)).date().isoformat()
+        index = self.rank_indexes.get((server_id, days))
+        if index is None or index.cutoff != cutoff:
+            # Registered before loading so changes made meanwhile are kept; see RankIndex.update
+            index = RankIndex(cutoff)
+            for (record_date, s_id, user_id), points in self.ledger.totals.items():
+                if s_id == server_id:
+                    index.update(user_id, record_date, points, 0)
+            self.rank_indexes[(server_id, days)] = index
+            index.loaded = asyncio.ensure_future(self.load_rank_index(server_id, index))
+        try:
+            await asyncio.shield(index.loaded)
+        except Exception:
+            if self.rank_indexes.get((server_id, days)) is index:
+                del self.rank_indexes[(server_id, days)]
+            raise
+        return index
+
+    async def load_rank_index(self, server_id: int, index: 'RankIndex'):
+        rows = await self.db.fetchall(GET_DAILY_WINDOW_QUERY, [server_id, index.cutoff])
+        index.load((int(row['user_id']), row['record_date'], row['points']) for row in rows)
+
+    @seniority.command()
+    @commands.guild_only()
+    async def leaderboard(self, ctx, days: int = None, count: int = 20):
+        """Show the users with the most points over the last `days` days.
+
+        `days` defaults to the grant lookback.
+        """
+        server = ctx.guild
+        days = max(1, min(days or self.settings.grant_lookback(server.id), 365))
+        count = max(1, min(count, 100))
+        index = await self.rank_index(server.id, days)
+
+        tbl = prettytable.PrettyTable(['Rank', 'User', 'Points'])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for rank, (user_id, points) in enumerate(index.top(count), start=1):
+            member = server.get_member(user_id)
+            tbl.add_row([rank, member.name if member else user_id, round(points, 2)])
+        msg = 'Top {} of {} users over {} days\n{}'.format(count, len(index), days, tbl.get_string())
+        for page in pagify(msg):
+            await ctx.send(box(page))
+
+    @seniority.command()
+    @commands.guild_only()
+    async def rank(self, ctx, user: discord.User, days: int = None):
+        """Show a user's rank by points over the last `days` days.
+
+        `days` defaults to the grant lookback.
+        """
+        server = ctx.guild
+        days = max(1, min(days or self.settings.grant_lookback(server.id), 365))
+        index = await self.rank_index(server.id, days)
+        rank = index.rank(user.id)
+        if rank is None:
+            await ctx.send(inline('{} has no points over {} days'.format(user.name, days)))
+            return
+        position, points = rank
+        await ctx.send(inline('{} is #{} of {} with {} points over {} days'.format(
+            user.name, position, len(index), round(points, 2), days)))
 
     async def queryAndPrint(self, ctx, server, query, values, max_rows=100, reverse=False, total=False):
+        await self.flush_points()
         before_time = timeit.default_timer()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(query, *values)
-                rows = await cur.fetchall()
-                columns = [x[0] for x in cur.description]
+        columns, rows = await self.db.query(query, values)
         execution_time = timeit.default_timer() - before_time
 
         if reverse:
@@ -786,36 +1167,16 @@ class Seniority(commands.Cog):
         tbl.vrules = prettytable.NONE
         tbl.align = 'l'
 
+        renderer = RowRenderer(self.bot, server)
+        formatters = renderer.formatters(columns)
+        # The last column is totalled unless it is one that gets resolved to a name
+        total_last = formatters and formatters[-1] is str
         grand_total = 0
 
-        for idx, row in enumerate(rows):
-            if idx > max_rows:
-                break
-
-            table_row = list()
-            for cidx, col in enumerate(columns):
-                raw_value = row[cidx]
-                value = str(raw_value)
-                if col == 'timestamp':
-                    # Assign a UTC timezone to the datetime
-                    raw_value = raw_value.replace(tzinfo=pytz.utc)
-                    # Change the UTC timezone to PT
-                    raw_value = DISCORD_DEFAULT_TZ.normalize(raw_value)
-                    value = raw_value.strftime("%F %X")
-                elif col == 'channel_id':
-                    channel = server.get_channel(int(value)) if server else None
-                    value = channel.name if channel else value
-                elif col == 'user_id':
-                    member = server.get_member(int(value)) if server else None
-                    value = member.name if member else value
-                elif col == 'server_id':
-                    server_obj = self.bot.get_guild(int(value))
-                    value = server_obj.name if server_obj else value
-                elif cidx + 1 == len(columns):
-                    grand_total += force_number(value)
-                table_row.append(value)
-
-            tbl.add_row(table_row)
+        for row in rows[:max_rows + 1]:
+            tbl.add_row([fmt(value) for fmt, value in zip(formatters, row)])
+            if total_last:
+                grand_total += force_number(str(row[-1]))
 
         result_text = "{} results fetched in {}s\n{}".format(
             len(rows), round(execution_time, 2), tbl.get_string())
@@ -827,86 +1188,564 @@ class Seniority(commands.Cog):
             await ctx.send(box(p))
 
 
-def ensure_map(item, key, default_value):
-    if key not in item:
-        item[key] = default_value
-    return item[key]
+class PointsLedger:
+    """Points per (record_date, server_id, channel_id, user_id), kept in memory.
+
+    A user's points for a day are loaded from the db the first time they are needed, so both
+    point caps are answered from memory.  Changes are written back in one batch by flush(), after
+    which days other than the current one are dropped.
+    """
+
+    def __init__(self, db: SqliteEngine):
+        self.db = db
+        # (record_date, server_id, channel_id, user_id) -> points
+        self.points = {}
+        # (record_date, server_id, user_id) -> points across channels; present once loaded
+        self.totals = {}
+        self.dirty = set()
+        # channel_id -> last message counted by catchup, written by the next flush
+        self.checkpoints = {}
+        self._loads = {}
+        # The flush loop, catchup and unload can all flush; one at a time keeps dirty consistent
+        self._flush_lock = asyncio.Lock()
+
+    async def load(self, record_date: str, server_id: int, user_id: int):
+        key = (record_date, server_id, user_id)
+        # A flush can evict a past day between the load finishing and a waiter resuming, so check again
+        while key not in self.totals:
+            if key not in self._loads:
+                self._loads[key] = asyncio.ensure_future(self._load(key))
+            await self._loads[key]
+
+    async def _load(self, key):
+        record_date, server_id, user_id = key
+        try:
+            rows = await self.db.fetchall(GET_DATE_POINTS_QUERY, [record_date, server_id, user_id])
+        finally:
+            del self._loads[key]
+        total = 0
+        for row in rows:
+            self.points[(record_date, server_id, int(row['channel_id']), user_id)] = row['points']
+            total += row['points']
+        self.totals[key] = total
+
+    def channel_points(self, record_date: str, server_id: int, channel_id: int, user_id: int) -> float:
+        return self.points.get((record_date, server_id, channel_id, user_id), 0)
+
+    def server_points(self, record_date: str, server_id: int, user_id: int) -> float:
+        return self.totals.get((record_date, server_id, user_id), 0)
+
+    def set_points(self, record_date: str, server_id: int, channel_id: int, user_id: int, points: float):
+        """Set a loaded user's points in a channel."""
+        key = (record_date, server_id, channel_id, user_id)
+        total_key = (record_date, server_id, user_id)
+        self.totals[total_key] += points - self.points.get(key, 0)
+        self.points[key] = points
+        self.dirty.add(key)
+
+    def set_checkpoint(self, channel_id: int, message_id: int):
+        """Record that catchup has counted everything in channel up to message_id."""
+        self.checkpoints[channel_id] = message_id
+
+    async def flush(self) -> int:
+        """Write every changed entry, its user's daily total and the catchup checkpoints in one
+        transaction, returning how many entries were written."""
+        async with self._flush_lock:
+            if not self.dirty and not self.checkpoints:
+                return 0
+            # Read every value before taking dirty, so a missing one can't drop the other changes
+            keys = set(self.dirty)
+            rows = [key + (self.points[key],) for key in keys]
+            days = {(d, s, u) for d, s, _, u in keys}
+            daily_rows = [(s, d, u, self.totals[(d, s, u)]) for d, s, u in days]
+            self.dirty -= keys
+            checkpoints, self.checkpoints = self.checkpoints, {}
+
+            def write(conn):
+                conn.executemany(REPLACE_POINTS_QUERY, rows)
+                conn.executemany(REPLACE_DAILY_POINTS_QUERY, daily_rows)
+                conn.executemany(REPLACE_CATCHUP_CHECKPOINT_QUERY, checkpoints.items())
+
+            try:
+                await self.db.write(write)
+            except Exception:
+                # forget_user may have dropped some of these while the write ran
+                self.dirty |= {key for key in keys if key in self.points}
+                self.checkpoints = {**checkpoints, **self.checkpoints}
+                raise
+            self.evict(now_date())
+            return len(rows)
+
+    def evict(self, current_date: str):
+        """Drop the written entries of days other than current_date."""
+        pending = {(d, s, u) for d, s, _, u in self.dirty}
+        for key in [k for k in self.totals if k[0] != current_date and k not in pending]:
+            del self.totals[key]
+        for key in [k for k in self.points if k[0] != current_date and (k[0], k[1], k[3]) not in pending]:
+            del self.points[key]
+
+    def forget_user(self, user_id: int):
+        self.dirty = {k for k in self.dirty if k[3] != user_id}
+        self.points = {k: v for k, v in self.points.items() if k[3] != user_id}
+        self.totals = {k: v for k, v in self.totals.items() if k[2] != user_id}
+
+
+class LookbackSnapshot:
+    """Every member's lookback points and role membership, as arrays aligned to member order.
+
+    Built once per command so each role's threshold check is a few array operations instead of a
+    pass over the member list.
+    """
+
+    def __init__(self, members, users_and_points, role_ids, blacklisted_ids):
+        userid_to_points = dict(users_and_points)
+        role_ids = set(role_ids)
+        self.member_ids = np.fromiter((m.id for m in members), dtype=np.int64, count=len(members))
+        self.points = np.fromiter((userid_to_points.get(m.id, 0) for m in members),
+                                  dtype=np.float64, count=len(members))
+        self.blacklisted = np.isin(self.member_ids, np.array([int(x) for x in blacklisted_ids], dtype=np.int64))
+
+        # role_id -> member positions, filled in one pass over each member's roles
+        positions = {role_id: [] for role_id in role_ids}
+        for idx, member in enumerate(members):
+            for role_id in {r.id for r in member.roles} & role_ids:
+                positions[role_id].append(idx)
+        self.has_role = {}
+        for role_id, idxs in positions.items():
+            mask = np.zeros(len(members), dtype=bool)
+            mask[idxs] = True
+            self.has_role[role_id] = mask
+
+    def users_for_role(self, role: discord.Role, amount: int, adding_role: bool):
+        """(user_id, points) of members to change, split into those to act on and blacklisted ones.
+
+        Adding looks at members without the role at or above amount, removing at members with the
+        role below it.
+        """
+        has_role = self.has_role[role.id]
+        if adding_role:
+            selected = ~has_role & (self.points >= amount)
+        else:
+            selected = has_role & (self.points < amount)
+        return self._pairs(selected & ~self.blacklisted), self._pairs(selected & self.blacklisted)
+
+    def _pairs(self, mask):
+        return list(zip(self.member_ids[mask].tolist(), self.points[mask].tolist()))
+
+
+class AcceptabilityFilter:
+    """One server's acceptability settings, ready to apply to message text.
+
+    Checks run cheapest first and stop at the first rejection.  Stripping emoji and mentions only
+    makes text shorter, so text already below the minimum length is rejected before any stripping.
+    """
+
+    def __init__(self, settings: 'SenioritySettings', server_id: int, prefixes: Sequence[str]):
+        self.prefixes = tuple(prefixes) if settings.ignore_commands(server_id) else ()
+        self.ignore_room_codes = settings.ignore_room_codes(server_id)
+        self.strip_patterns = []
+        if settings.ignore_emoji(server_id):
+            self.strip_patterns.append(EMOJI_PATTERN)
+        if settings.ignore_mentions(server_id):
+            self.strip_patterns.append(MENTION_PATTERN)
+        self.min_length = settings.min_length(server_id)
+        self.min_words = settings.min_words(server_id)
+        self.built_at = timeit.default_timer()
+
+    def age(self) -> float:
+        return timeit.default_timer() - self.built_at
+
+    def check(self, text: str) -> Tuple[bool, str, str]:
+        """Whether text earns points, the text with emoji/mentions removed, and why."""
+        if self.prefixes and text.startswith(self.prefixes):
+            return False, text, 'Ignored command'
+
+        if self.ignore_room_codes and ROOM_CODE_PATTERN.search(text):
+            return False, text, 'Ignored room code'
+
+        if len(text) < self.min_length:
+            return False, text, 'Min length'
+
+        for pattern in self.strip_patterns:
+            text = pattern.sub('', text)
+
+        if len(text) < self.min_length:
+            return False, text, 'Min length'
+
+        if len(text.split()) < self.min_words:
+            return False, text, 'Min words'
+
+        return True, text, 'Passed!'
+
+
+def synthetic_messages(count: int, prefix: str) -> List[Tuple[str, str]]:
+    """Deterministic (kind, text) pairs in roughly the mix a chat channel sees."""
+    rng = random.Random(count)
+    words = ['whale', 'carry', 'team', 'dungeon', 'pull', 'rem', 'stamina', 'leader', 'skill', 'awoken',
+             'the', 'a', 'is', 'on', 'my', 'for', 'and', 'lol', 'anyone', 'help', 'with', 'this']
+    kinds = [
+        ('short', 0.25, lambda: ' '.join(rng.choice(words) for _ in range(rng.randint(1, 3)))),
+        ('text', 0.4, lambda: ' '.join(rng.choice(words) for _ in range(rng.randint(4, 60)))),
+        ('command', 0.1, lambda: '{}{} {}'.format(prefix, rng.choice(words), rng.choice(words))),
+        ('emoji', 0.1, lambda: '{} <:{}:{}> <a:{}:{}>'.format(
+            rng.choice(words), rng.choice(words), rng.randrange(10 ** 17, 10 ** 19),
+            rng.choice(words), rng.randrange(10 ** 17, 10 ** 19))),
+        ('mention', 0.1, lambda: '<@!{}> {} {}'.format(
+            rng.randrange(10 ** 17, 10 ** 19), rng.choice(words), rng.choice(words))),
+        ('room code', 0.05, lambda: 'join {:04d} {:04d} {}'.format(
+            rng.randrange(10 ** 4), rng.randrange(10 ** 4), rng.choice(words))),
+    ]
+    names = [kind for kind, _, _ in kinds]
+    weights = [weight for _, weight, _ in kinds]
+    makers = {kind: make for kind, _, make in kinds}
+    return [(kind, makers[kind]()) for kind in rng.choices(names, weights, k=count)]
+
+
+def benchmark_filter(acceptability_filter: AcceptabilityFilter, messages: List[Tuple[str, str]]):
+    """(kind, count, accepted, seconds) for each kind of message, then for all of them."""
+    by_kind = {}
+    for kind, text in messages:
+        by_kind.setdefault(kind, []).append(text)
+    by_kind['all'] = [text for _, text in messages]
+
+    results = []
+    check = acceptability_filter.check
+    for kind, texts in by_kind.items():
+        before_time = timeit.default_timer()
+        accepted = sum(check(text)[0] for text in texts)
+        results.append((kind, len(texts), accepted, timeit.default_timer() - before_time))
+    return results
+
+
+class RankIndex:
+    """One server's users ordered by their points since cutoff, kept current as points are saved.
+
+    Top-k reads are O(k) and a user's rank O(log n).  The index is only valid for one cutoff date;
+    a new one is built when the window moves on.
+    """
+
+    def __init__(self, cutoff: str):
+        self.cutoff = cutoff
+        self.loaded = None
+        # user_id -> points
+        self.points: Dict[int, float] = {}
+        # (-points, user_id), so the highest points come first
+        self.order = SortedList()
+        # (user_id, record_date) -> points; the latest totals seen while loading
+        self._overrides: Optional[Dict[Tuple[int, str], float]] = {}
+
+    def __len__(self):
+        return len(self.order)
+
+    def update(self, user_id: int, record_date: str, total: float, delta: float):
+        """Apply a change to a user's total for a day, now total after changing by delta.
+
+        Until load() the day's latest total is kept instead.  It replaces whatever the load reads
+        for that day, which may or may not include the change depending on when it was flushed.
+        """
+        if record_date < self.cutoff:
+            return
+        if self._overrides is not None:
+            self._overrides[(user_id, record_date)] = total
+        elif delta:
+            self._set(user_id, self.points.get(user_id, 0) + delta)
+
+    def load(self, rows):
+        """Fill the index from (user_id, record_date, points) rows of the daily totals."""
+        day_points = {(user_id, record_date): points for user_id, record_date, points in rows}
+        day_points.update(self._overrides)
+        self._overrides = None
+        totals = {}
+        for (user_id, _), points in day_points.items():
+            totals[user_id] = totals.get(user_id, 0) + points
+        self.points = totals
+        self.order = SortedList((-points, user_id) for user_id, points in totals.items())
+
+    def _set(self, user_id: int, points: float):
+        old = self.points.get(user_id)
+        if old is not None:
+            self.order.remove((-old, user_id))
+        self.points[user_id] = points
+        self.order.add((-points, user_id))
+
+    def top(self, count: int) -> List[Tuple[int, float]]:
+        return [(user_id, -neg_points) for neg_points, user_id in self.order.islice(0, count)]
+
+    def rank(self, user_id: int) -> Optional[Tuple[int, float]]:
+        """The user's 1-based position and points, or None if they have none in the window."""
+        points = self.points.get(user_id)
+        if points is None:
+            return None
+        return self.order.index((-points, user_id)) + 1, points
+
+    def forget_user(self, user_id: int):
+        if self._overrides is not None:
+            self._overrides = {k: v for k, v in self._overrides.items() if k[0] != user_id}
+        points = self.points.pop(user_id, None)
+        if points is not None:
+            self.order.remove((-points, user_id))
+
+
+def export_rows(conn, query: str, args: Sequence, file_format: str) -> Tuple[IO[bytes], int]:
+    """Write a query's results to a temporary file a chunk at a time, returning it and the row count."""
+    cur = conn.execute(query, args)
+    columns = [d[0] for d in cur.description]
+    out = tempfile.TemporaryFile()
+    rows = 0
+    if file_format == 'csv':
+        text = TextIOWrapper(out, encoding='utf-8', newline='', write_through=True)
+        writer = csv.writer(text)
+        writer.writerow(columns)
+        for chunk in iter(lambda: cur.fetchmany(EXPORT_CHUNK_ROWS), []):
+            writer.writerows(chunk)
+            rows += len(chunk)
+        text.detach()
+    else:
+        schema = pyarrow.schema([(column, EXPORT_TYPES[column]) for column in columns])
+        with pyarrow.parquet.ParquetWriter(out, schema) as writer:
+            for chunk in iter(lambda: cur.fetchmany(EXPORT_CHUNK_ROWS), []):
+                data = {column: [row[idx] for row in chunk] for idx, column in enumerate(columns)}
+                writer.write_table(pyarrow.table(data, schema=schema))
+                rows += len(chunk)
+    out.seek(0)
+    return out, rows
+
+
+def render_heatmap(day_points: List[Tuple[str, float]], start: date, end: date, title: str) -> bytes:
+    """A calendar of points per day from start to end, one column per week, as a png."""
+    bg_color = "#190432"
+    fg_color = "#dfcdf6"
+
+    first_monday = start - timedelta(days=start.weekday())
+    weeks = (end - first_monday).days // 7 + 1
+    # Days outside start..end stay blank; days inside without points show as zero
+    grid = np.full((7, weeks), np.nan)
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        grid[day.weekday(), (day - first_monday).days // 7] = 0
+    for record_date, points in day_points:
+        day = date.fromisoformat(record_date)
+        if start <= day <= end:
+            grid[day.weekday(), (day - first_monday).days // 7] = points
+
+    fig = Figure(figsize=(max(4, weeks * 0.18 + 1.5), 2.4), facecolor=bg_color)
+    sp = fig.add_subplot()
+    sp.set_facecolor(bg_color)
+    image = sp.imshow(np.ma.masked_invalid(grid), cmap='Greens', aspect='equal', vmin=0)
+    sp.set_yticks(range(7))
+    sp.set_yticklabels(['Mon', '', 'Wed', '', 'Fri', '', 'Sun'])
+    months = [(week, first_monday + timedelta(weeks=week)) for week in range(weeks)]
+    month_starts = [(week, day) for week, day in months if day.day <= 7]
+    sp.set_xticks([week for week, _ in month_starts])
+    sp.set_xticklabels([day.strftime('%b') for _, day in month_starts])
+    sp.tick_params(axis='both', colors=fg_color, length=0)
+    for spine in sp.spines.values():
+        spine.set_visible(False)
+    sp.set_title(title, color=fg_color)
+    colorbar = fig.colorbar(image, ax=sp, shrink=0.8)
+    colorbar.ax.tick_params(colors=fg_color)
+
+    buf = BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight')
+    return buf.getvalue()
+
+
+def check_query_plan(conn, query: str, allowed: Sequence[str]):
+    """Plan a query, returning the plan lines and the steps in it that it isn't allowed."""
+    details = [r[3] for r in conn.execute('EXPLAIN QUERY PLAN ' + query, [0] * query.count('?'))]
+    problems = []
+    for d in details:
+        if d.startswith('SCAN ') and not d.startswith('SCAN (') and 'scan' not in allowed:
+            problems.append(d)
+        elif 'TEMP B-TREE' in d and 'sort' not in allowed:
+            problems.append(d)
+    return details, problems
+
+
+def check_schema(conn) -> List[str]:
+    """Report lines for every planned query and every table's secondary indexes."""
+    lines = []
+    for name, query, allowed in PLANNED_QUERIES:
+        details, problems = check_query_plan(conn, query, allowed)
+        lines.append('{}: {}'.format(name, 'FAIL, ' + '; '.join(problems) if problems else 'OK'))
+        lines.extend('    ' + d for d in details)
+    for table, expected in EXPECTED_INDEXES.items():
+        indexes = [r[0] for r in conn.execute(GET_INDEXES_QUERY, [table])]
+        status = 'OK' if len(indexes) == expected else 'FAIL, expected {}'.format(expected)
+        lines.append('{} indexes: {} {}'.format(table, len(indexes), status))
+        lines.extend('    ' + index for index in indexes)
+    return lines
+
+
+def migrate_table(conn):
+    for query in MIGRATE_TABLE_QUERIES:
+        conn.execute(query)
+
+
+def rebuild_daily_table(conn) -> int:
+    for query in REBUILD_DAILY_QUERIES:
+        rows = conn.execute(query).rowcount
+    return rows
 
 
 def now_date():
     return datetime.now(DISCORD_DEFAULT_TZ).date().isoformat()
 
 
-class SenioritySettings(CogSettings):
-    def make_default_settings(self):
-        config = {
-            'servers': {}
+class GuildSettings:
+    """One server's settings, stored in Config in the same sections the old JSON file used."""
+
+    __slots__ = ['announce_channel', 'auto_grant', 'message_cap', 'server_point_cap', 'grant_lookback',
+                 'remove_lookback', 'ignore_commands', 'ignore_emoji', 'ignore_mentions', 'ignore_room_codes',
+                 'min_length', 'min_words', 'roles', 'blacklist', 'channels']
+
+    CONFIG_DEFAULTS = {
+        'announce_channel': '',
+        'auto_grant': False,
+        'message_cap': 20,
+        'server_point_cap': 5,
+        'grant_lookback': 90,
+        'remove_lookback': 90,
+    }
+
+    UTTERANCES_DEFAULTS = {
+        'ignore_commands': True,
+        'ignore_emoji': True,
+        'ignore_mentions': True,
+        'ignore_room_codes': True,
+        'min_length': 30,
+        'min_words': 5,
+    }
+
+    def __init__(self, data: dict = None):
+        data = data or {}
+        for section, defaults in [('config', self.CONFIG_DEFAULTS), ('utterances', self.UTTERANCES_DEFAULTS)]:
+            values = data.get(section) or {}
+            for key, default in defaults.items():
+                setattr(self, key, values.get(key, default))
+        # Config and the old JSON file store ids as strings
+        self.roles: Dict[int, dict] = int_keys(data.get('roles'))
+        self.blacklist: Dict[int, dict] = int_keys(data.get('blacklist'))
+        self.channels: Dict[int, dict] = int_keys(data.get('channels'))
+
+    def to_dict(self) -> dict:
+        return {
+            'config': {key: getattr(self, key) for key in self.CONFIG_DEFAULTS},
+            'utterances': {key: getattr(self, key) for key in self.UTTERANCES_DEFAULTS},
+            'roles': {str(k): v for k, v in self.roles.items()},
+            'blacklist': {str(k): v for k, v in self.blacklist.items()},
+            'channels': {str(k): v for k, v in self.channels.items()},
         }
-        return config
-
-    def servers(self):
-        return self.bot_settings['servers']
-
-    def server(self, server_id: int):
-        servers = self.servers()
-        return ensure_map(servers, server_id, {})
-
-    def config(self, server_id: int):
-        server = self.server(server_id)
-        config = ensure_map(server, 'config', {})
-        ensure_map(config, 'announce_channel', '')
-        ensure_map(config, 'auto_grant', False)
-        ensure_map(config, 'message_cap', 20)
-        ensure_map(config, 'server_point_cap', 5)
-        ensure_map(config, 'grant_lookback', 90)
-        ensure_map(config, 'remove_lookback', 90)
-        return config
+
+
+class SenioritySettings:
+    """Every server's GuildSettings, kept in memory.
+
+    Setters only touch memory and mark the server changed.  Changed servers are written to Config
+    together once SETTINGS_SAVE_SECONDS have passed, one Config set per server.
+    """
+
+    def __init__(self, bot: Red, config: Config):
+        self.bot = bot
+        self.config = config
+        self.guilds: Dict[int, GuildSettings] = {}
+        self._dirty = set()
+        self._save_task = None
+
+    async def load(self):
+        if not await self.config.legacy_settings_migrated():
+            await self.migrate_legacy_settings()
+        for server_id, data in (await self.config.all_guilds()).items():
+            self.guilds[server_id] = GuildSettings(data)
+
+    async def migrate_legacy_settings(self):
+        """Copy the servers from the old whole-file JSON settings into Config, once."""
+        path = os.path.join(str(cog_data_path(raw_name='seniority')), LEGACY_SETTINGS_FILE)
+        if os.path.isfile(path):
+            with open(path) as f:
+                servers = json.load(f).get('servers', {})
+            for server_id, data in servers.items():
+                await self.config.guild_from_id(int(server_id)).set(GuildSettings(data).to_dict())
+            logger.info('Migrated settings for %s servers from %s', len(servers), path)
+        await self.config.legacy_settings_migrated.set(True)
+
+    async def close(self):
+        if self._save_task:
+            self._save_task.cancel()
+        await self.save_now()
+
+    def guild(self, server_id: int) -> GuildSettings:
+        settings = self.guilds.get(server_id)
+        if settings is None:
+            settings = self.guilds[server_id] = GuildSettings()
+        return settings
+
+    def save_settings(self, server_id: int):
+        self._dirty.add(server_id)
+        if self._save_task is None:
+            self._save_task = self.bot.loop.create_task(self.save_later())
+
+    async def save_later(self):
+        await asyncio.sleep(SETTINGS_SAVE_SECONDS)
+        self._save_task = None
+        try:
+            await self.save_now()
+        except Exception:
+            logger.exception('Failed to save seniority settings')
+
+    async def save_now(self):
+        dirty, self._dirty = self._dirty, set()
+        try:
+            for server_id in sorted(dirty):
+                await self.config.guild_from_id(server_id).set(self.guild(server_id).to_dict())
+                dirty.discard(server_id)
+        finally:
+            self._dirty |= dirty
 
     def announce_channel(self, server_id: int):
-        return self.config(server_id)['announce_channel']
+        return self.guild(server_id).announce_channel
 
     def auto_grant(self, server_id: int):
-        return self.config(server_id)['auto_grant']
+        return self.guild(server_id).auto_grant
 
     def message_cap(self, server_id: int):
-        return self.config(server_id)['message_cap']
+        return self.guild(server_id).message_cap
 
     def server_point_cap(self, server_id: int):
-        return self.config(server_id)['server_point_cap']
+        return self.guild(server_id).server_point_cap
 
     def grant_lookback(self, server_id: int):
-        return self.config(server_id)['grant_lookback']
+        return self.guild(server_id).grant_lookback
 
     def remove_lookback(self, server_id: int):
-        return self.config(server_id)['remove_lookback']
+        return self.guild(server_id).remove_lookback
 
     def set_announce_channel(self, server_id: int, channel_id):
-        self.config(server_id)['announce_channel'] = channel_id
-        self.save_settings()
+        self.guild(server_id).announce_channel = channel_id
+        self.save_settings(server_id)
 
     def set_auto_grant(self, server_id: int, auto_grant: bool):
-        self.config(server_id)['auto_grant'] = auto_grant
-        self.save_settings()
+        self.guild(server_id).auto_grant = auto_grant
+        self.save_settings(server_id)
 
     def set_message_cap(self, server_id: int, message_cap: int):
-        self.config(server_id)['message_cap'] = message_cap
-        self.save_settings()
+        self.guild(server_id).message_cap = message_cap
+        self.save_settings(server_id)
 
     def set_server_point_cap(self, server_id: int, server_point_cap: int):
-        self.config(server_id)['server_point_cap'] = server_point_cap
-        self.save_settings()
+        self.guild(server_id).server_point_cap = server_point_cap
+        self.save_settings(server_id)
 
     def set_grant_lookback(self, server_id: int, lookback: int):
-        self.config(server_id)['grant_lookback'] = lookback
-        self.save_settings()
+        self.guild(server_id).grant_lookback = lookback
+        self.save_settings(server_id)
 
     def set_remove_lookback(self, server_id: int, lookback: int):
-        self.config(server_id)['remove_lookback'] = lookback
-        self.save_settings()
+        self.guild(server_id).remove_lookback = lookback
+        self.save_settings(server_id)
 
     def roles(self, server_id):
-        server = self.server(server_id)
-        return ensure_map(server, 'roles', {})
+        return self.guild(server_id).roles
 
     def set_role(self, server_id: int, role_id: int, remove_amount: int, warn_amount: int, grant_amount: int):
         roles = self.roles(server_id)
@@ -925,64 +1764,52 @@ class SenioritySettings(CogSettings):
                 'warn_amount': warn_amount,
                 'grant_amount': grant_amount,
             }
-        self.save_settings()
-
-    def utterances(self, server_id: int):
-        server = self.server(server_id)
-        utterances = ensure_map(server, 'utterances', {})
-        ensure_map(utterances, 'ignore_commands', True)
-        ensure_map(utterances, 'ignore_emoji', True)
-        ensure_map(utterances, 'ignore_mentions', True)
-        ensure_map(utterances, 'ignore_room_codes', True)
-        ensure_map(utterances, 'min_length', 30)
-        ensure_map(utterances, 'min_words', 5)
-        return utterances
+        self.save_settings(server_id)
 
     def ignore_commands(self, server_id: int):
-        return self.utterances(server_id)['ignore_commands']
+        return self.guild(server_id).ignore_commands
 
     def ignore_emoji(self, server_id: int):
-        return self.utterances(server_id)['ignore_emoji']
+        return self.guild(server_id).ignore_emoji
 
     def ignore_mentions(self, server_id: int):
-        return self.utterances(server_id)['ignore_mentions']
+        return self.guild(server_id).ignore_mentions
 
     def ignore_room_codes(self, server_id: int):
-        return self.utterances(server_id)['ignore_room_codes']
+        return self.guild(server_id).ignore_room_codes
 
     def min_length(self, server_id: int):
-        return self.utterances(server_id)['min_length']
+        return self.guild(server_id).min_length
 
     def min_words(self, server_id: int):
-        return self.utterances(server_id)['min_words']
+        return self.guild(server_id).min_words
 
     def set_ignore_commands(self, server_id: int, ignore: bool):
-        self.utterances(server_id)['ignore_commands'] = ignore
-        self.save_settings()
+        self.guild(server_id).ignore_commands = ignore
+        self.save_settings(server_id)
 
     def set_ignore_emoji(self, server_id: int, ignore: bool):
-        self.utterances(server_id)['ignore_emoji'] = ignore
-        self.save_settings()
+        self.guild(server_id).ignore_emoji = ignore
+        self.save_settings(server_id)
 
     def set_ignore_mentions(self, server_id: int, ignore: bool):
-        self.utterances(server_id)['ignore_mentions'] = ignore
-        self.save_settings()
+        self.guild(server_id).ignore_mentions = ignore
+        self.save_settings(server_id)
 
     def set_ignore_room_codes(self, server_id: int, ignore: bool):
-        self.utterances(server_id)['ignore_room_codes'] = ignore
-        self.save_settings()
+        self.guild(server_id).ignore_room_codes = ignore
+        self.save_settings(server_id)
 
     def set_min_length(self, server_id: int, min_length: int):
-        self.utterances(server_id)['min_length'] = min_length
-        self.save_settings()
+        self.guild(server_id).min_length = min_length
+        self.save_settings(server_id)
 
     def set_min_words(self, server_id: int, min_words: int):
-        self.utterances(server_id)['min_words'] = min_words
-        self.save_settings()
+        self.guild(server_id).min_words = min_words
+        self.save_settings(server_id)
 
     def blacklist(self, server_id: int):
-        server = self.server(server_id)
-        return ensure_map(server, 'blacklist', {})
+        return self.guild(server_id).blacklist
 
     def add_blacklist(self, server_id: int, user_id: int, by_id: str, reason: str):
         blacklist = self.blacklist(server_id)
@@ -992,17 +1819,16 @@ class SenioritySettings(CogSettings):
             'ignore_date': now_date(),
             'reason': reason,
         }
-        self.save_settings()
+        self.save_settings(server_id)
 
     def remove_blacklist(self, server_id: int, user_id: int):
         blacklist = self.blacklist(server_id)
         result = blacklist.pop(user_id, None)
-        self.save_settings()
+        self.save_settings(server_id)
         return result
 
     def channels(self, server_id: int):
-        server = self.server(server_id)
-        return ensure_map(server, 'channels', {})
+        return self.guild(server_id).channels
 
     def set_channel(self, server_id: int, channel_id: int, max_ppd: int):
         channels = self.channels(server_id)
@@ -1013,7 +1839,11 @@ class SenioritySettings(CogSettings):
                 'channel_id': channel_id,
                 'max_ppd': max_ppd,
             }
-        self.save_settings()
+        self.save_settings(server_id)
+
+
+def int_keys(item: Optional[dict]) -> dict:
+    return {int(k): v for k, v in (item or {}).items()}
 
 
 def force_number(s):
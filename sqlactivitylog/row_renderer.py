@@ -0,0 +1,81 @@
+"""Turns query rows into table cells for the owner/mod query commands.
+
+Ids are resolved to names once per distinct id, the UTC offset of the display timezone is looked
+up once per hour of timestamps, and each column's formatter is picked once per query rather than
+once per cell.
+
+Red installs cogs independently, so sqlactivitylog and seniority each carry a copy of this
+module.  Keep the copies identical.
+"""
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import pytz
+from tsutils.time import DISCORD_DEFAULT_TZ
+
+Formatter = Callable[[Any], str]
+
+
+class RowRenderer:
+    def __init__(self, bot, server, tz=DISCORD_DEFAULT_TZ):
+        self.bot = bot
+        self.server = server
+        self.tz = tz
+        self._names: Dict[Tuple[str, Any], str] = {}
+        self._offsets: Dict[Tuple[int, int, int, int], timedelta] = {}
+
+    def formatter(self, column: str) -> Formatter:
+        """The function that turns a raw value of column into display text."""
+        if column == 'timestamp':
+            return self.timestamp
+        if column in ('channel_id', 'user_id', 'server_id'):
+            return lambda value: self.name(column, value)
+        return str
+
+    def formatters(self, columns: Sequence[str]) -> List[Formatter]:
+        return [self.formatter(column) for column in columns]
+
+    def render(self, columns: Sequence[str], row: Sequence) -> List[str]:
+        return [fmt(value) for fmt, value in zip(self.formatters(columns), row)]
+
+    def timestamp(self, value) -> str:
+        """Show a naive UTC datetime (or its stored text) in the display timezone."""
+        if value is None:
+            return str(value)
+        if not isinstance(value, datetime):
+            value = datetime.fromisoformat(value)
+        hour = (value.year, value.month, value.day, value.hour)
+        offset = self._offsets.get(hour)
+        if offset is None:
+            offset = self.tz.normalize(value.replace(tzinfo=pytz.utc)).utcoffset()
+            self._offsets[hour] = offset
+        return (value + offset).strftime('%F %X')
+
+    def name(self, column: str, value) -> str:
+        key = (column, value)
+        name = self._names.get(key)
+        if name is None:
+            name = self._lookup(column, value)
+            self._names[key] = name
+        return name
+
+    def _lookup(self, column: str, value) -> str:
+        try:
+            obj_id = int(value)
+        except (TypeError, ValueError):
+            return str(value)
+        if column == 'server_id':
+            obj = self.bot.get_guild(obj_id)
+        elif self.server is None:
+            return str(value)
+        elif column == 'channel_id':
+            obj = self.server.get_channel(obj_id)
+        else:
+            obj = self.server.get_member(obj_id)
+        return obj.name if obj else str(value)
+
+
+def column_indices(columns: Sequence[str], wanted: Sequence[str]) -> List[Optional[int]]:
+    """Position of each wanted column in columns, or None if the query didn't return it."""
+    positions = {column: idx for idx, column in enumerate(columns)}
+    return [positions.get(column) for column in wanted]
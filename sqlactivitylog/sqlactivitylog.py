@@ -1,24 +1,31 @@
+import asyncio
+import json
 import logging
 import os
+import random
+import re
+import sqlite3
+import tempfile
 import textwrap
 import timeit
-import warnings
-from collections import deque
-from datetime import datetime, timedelta
+import zlib
+from collections import defaultdict, deque
+from datetime import datetime, timedelta, timezone
+from functools import partial
 from io import BytesIO
+from typing import Optional
 
-import aioodbc
 import discord
 import prettytable
 import pytz
-import sys
 from redbot.core import checks, commands, data_manager
 from redbot.core.bot import Red
 from redbot.core.utils.chat_formatting import box, inline, pagify
 from tsutils.time import DISCORD_DEFAULT_TZ
-import pyodbc
 
-warnings.filterwarnings("ignore")  # AIOODBC sucks
+from .row_renderer import RowRenderer, column_indices
+from .sqlite_engine import SqliteEngine
+
 logger = logging.getLogger('red.misc-cogs.sqlactivitylog')
 
 
@@ -36,7 +43,13 @@ def _data_file(file_name: str) -> str:
 
 
 TIMESTAMP_FORMAT = '%Y-%m-%d %X'  # YYYY-MM-DD HH:MM:SS
+# Timestamps are stored as UTC text, which sorts and compares correctly as a string
+STORED_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
 DB_FILE = _data_file("log.db")
+# Events seen while the log is locked are buffered, appended here as JSON lines in batches, and
+# inserted on unlock.  The spool is renamed to the replay file first, so events spooled during a replay aren't lost.
+SPOOL_FILE = _data_file("spool.jsonl")
+SPOOL_REPLAY_FILE = _data_file("spool.replaying.jsonl")
 
 ALL_COLUMNS = [
     ('timestamp', 'Time (PT)'),
@@ -47,124 +60,399 @@ ALL_COLUMNS = [
     ('clean_content', 'Message'),
 ]
 
-CREATE_TABLE = '''
-CREATE TABLE IF NOT EXISTS messages(
+MAX_LOGS = 500
+RETENTION_DAYS = 7 * 3
+PURGE_INTERVAL_SECONDS = 60 * 60
+
+# exlog results are fetched and sent EXLOG_PAGE_ROWS at a time, newest first.  Each page continues
+# from the (timestamp, rowid) key of the last row sent; START_KEY sorts after every stored row.
+EXLOG_PAGE_ROWS = 25
+START_KEY = ('9999-12-31 23:59:59.999999', 2 ** 63 - 1)
+
+# exlog since/until arguments, read in DISCORD_DEFAULT_TZ
+LOG_TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%H:%M']
+LOG_AGE_PATTERN = re.compile(r'^(\d+)([mhd])$')
+LOG_AGE_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+
+# Rows are buffered by log() and written in batches by flush_loop(); a batch is written once it
+# reaches FLUSH_BATCH_SIZE rows or FLUSH_INTERVAL_SECONDS after it was started, whichever is first.
+MAX_QUEUED_ROWS = 20000
+FLUSH_BATCH_SIZE = 500
+FLUSH_INTERVAL_SECONDS = 2
+
+# Messages are stored in one table per UTC day (messages_YYYYMMDD) so that retention can drop
+# whole tables instead of deleting rows.  The messages view unions every partition for ad-hoc
+# queries; the exlog queries below are templates run against each partition in turn.
+PARTITION_PREFIX = 'messages_'
+PARTITION_PATTERN = re.compile(r'^messages_\d{8}$')
+
+# Each partition's AUTOINCREMENT counter starts at its day ordinal * ROWID_STRIDE, which keeps
+# rowids unique and increasing across partitions.
+ROWID_STRIDE = 10 ** 9
+
+# The schema version is kept in PRAGMA user_version and upgraded by SqliteEngine.migrate() in the
+# background after startup.  Partitions are rebuilt by copying MIGRATION_CHUNK_ROWS rows per write
+# into {table}_migrating, so logging carries on while a migration runs.
+MIGRATION_CHUNK_ROWS = 5000
+MIGRATING_SUFFIX = '_migrating'
+
+# content is stored as NULL when it matches clean_content, otherwise as a raw deflate stream using
+# clean_content as the preset dictionary, so only the difference costs space.  Attachments and
+# embeds are kept one row each in {table}_extras instead of being appended to both texts.
+CONTENT_COMPRESSION_LEVEL = 6
+
+CREATE_PARTITION = '''
+CREATE TABLE IF NOT EXISTS {table}(
   rowid INTEGER PRIMARY KEY ASC AUTOINCREMENT,
-  timestamp TIMESTAMP NOT NULL,
-  server_id STRING NOT NULL,
-  channel_id STRING NOT NULL,
-  user_id STRING NOT NULL,
-  msg_type STRING NOT NULL,
-  content STRING NOT NULL,
-  clean_content STRING NOT NULL)
+  timestamp TEXT NOT NULL,
+  server_id INTEGER NOT NULL,
+  channel_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  msg_type TEXT NOT NULL,
+  content BLOB,
+  clean_content TEXT NOT NULL)
 '''
 
-CREATE_INDEX_1 = '''
-CREATE INDEX IF NOT EXISTS idx_messages_server_id_channel_id_user_id_timestamp
-ON messages(server_id, channel_id, user_id, timestamp)
+CREATE_EXTRAS_TABLE = '''
+CREATE TABLE IF NOT EXISTS {table}_extras(
+  message_rowid INTEGER NOT NULL,
+  position INTEGER NOT NULL,
+  kind TEXT NOT NULL,
+  data TEXT NOT NULL,
+  PRIMARY KEY (message_rowid, position)) WITHOUT ROWID
 '''
 
-CREATE_INDEX_2 = '''
-CREATE INDEX IF NOT EXISTS idx_messages_server_id_user_id_timestamp
-ON messages(server_id, user_id, timestamp)
+CREATE_EXTRAS_DELETE_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS {table}_extras_delete AFTER DELETE ON {table} BEGIN
+  DELETE FROM {table}_extras WHERE message_rowid = old.rowid;
+END
 '''
 
-CREATE_INDEX_3 = '''
-CREATE INDEX IF NOT EXISTS idx_messages_server_id_clean_content
-ON messages(server_id, clean_content)
+SEED_PARTITION_ROWID = '''
+INSERT INTO sqlite_sequence(name, seq)
+SELECT ?, ?
+WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+'''
+
+CREATE_INDEX_1 = '''
+CREATE INDEX IF NOT EXISTS idx_{table}_server_id_channel_id_user_id_timestamp
+ON {table}(server_id, channel_id, user_id, timestamp)
+'''
+
+CREATE_INDEX_2 = '''
+CREATE INDEX IF NOT EXISTS idx_{table}_server_id_user_id_timestamp
+ON {table}(server_id, user_id, timestamp)
 '''
 
 CREATE_INDEX_4 = '''
-CREATE INDEX IF NOT EXISTS idx_messages_server_id_timestamp
-ON messages(server_id, timestamp)
+CREATE INDEX IF NOT EXISTS idx_{table}_server_id_timestamp
+ON {table}(server_id, timestamp)
 '''
 
 CREATE_INDEX_5 = '''
-CREATE INDEX IF NOT EXISTS idx_messages_server_id_channel_id_timestamp
-ON messages(server_id, channel_id, timestamp)
+CREATE INDEX IF NOT EXISTS idx_{table}_server_id_channel_id_timestamp
+ON {table}(server_id, channel_id, timestamp)
 '''
 
-MAX_LOGS = 500
+# External content FTS5 index over clean_content, kept in sync with its partition by the
+# triggers below.  It is dropped together with the partition.
+CREATE_FTS_TABLE = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts
+USING fts5(clean_content, content='{table}', content_rowid='rowid')
+'''
+
+CREATE_FTS_INSERT_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+  INSERT INTO {table}_fts(rowid, clean_content) VALUES (new.rowid, new.clean_content);
+END
+'''
+
+CREATE_FTS_DELETE_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+  INSERT INTO {table}_fts({table}_fts, rowid, clean_content) VALUES ('delete', old.rowid, old.clean_content);
+END
+'''
+
+CREATE_FTS_UPDATE_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table} BEGIN
+  INSERT INTO {table}_fts({table}_fts, rowid, clean_content) VALUES ('delete', old.rowid, old.clean_content);
+  INSERT INTO {table}_fts(rowid, clean_content) VALUES (new.rowid, new.clean_content);
+END
+'''
+
+REBUILD_FTS = '''
+INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')
+'''
+
+TABLE_TYPE_QUERY = '''
+SELECT type FROM sqlite_master WHERE name = ?
+'''
+
+LIST_TABLES_QUERY = '''
+SELECT name FROM sqlite_master WHERE type = 'table'
+'''
+
+DROP_VIEW = '''
+DROP VIEW IF EXISTS messages
+'''
+
+CREATE_VIEW = '''
+CREATE VIEW messages AS
+{selects}
+'''
+
+DROP_PARTITION = '''
+DROP TABLE IF EXISTS {table}
+'''
+
+DROP_FTS = '''
+DROP TABLE IF EXISTS {table}_fts
+'''
+
+DROP_EXTRAS = '''
+DROP TABLE IF EXISTS {table}_extras
+'''
+
+COUNT_ROWS_QUERY = '''
+SELECT count(*) FROM {table}
+'''
+
+COLUMN_TYPE_QUERY = '''
+SELECT type FROM pragma_table_info(?) WHERE name = ?
+'''
+
+# Rebuilds a partition of any earlier schema into the current one.  Schema 1 replaced STRING
+# (NUMERIC affinity) ids and text; schema 2 compressed content.
+MIGRATE_LAST_ROWID = '''
+SELECT coalesce(max(rowid), 0) FROM {table}_migrating
+'''
+
+MIGRATE_COPY_CHUNK = '''
+INSERT INTO {table}_migrating(rowid, timestamp, server_id, channel_id, user_id, msg_type, content,
+                              clean_content)
+SELECT rowid, CAST(timestamp AS TEXT), CAST(server_id AS INTEGER), CAST(channel_id AS INTEGER),
+       CAST(user_id AS INTEGER), CAST(msg_type AS TEXT),
+       compress_content(CAST(content AS TEXT), CAST(clean_content AS TEXT)),
+       CAST(clean_content AS TEXT)
+FROM {table}
+WHERE rowid > ?
+ORDER BY rowid
+LIMIT ?
+'''
+
+MIGRATE_DROP_DELETED = '''
+DELETE FROM {table}_migrating
+WHERE rowid NOT IN (SELECT rowid FROM {table})
+'''
+
+MIGRATE_RENAME = '''
+ALTER TABLE {table}_migrating RENAME TO {table}
+'''
+
+# Used once to move rows out of the single messages table that predates partitioning
+LEGACY_DROP_FTS = [
+    'DROP TRIGGER IF EXISTS messages_fts_insert',
+    'DROP TRIGGER IF EXISTS messages_fts_delete',
+    'DROP TRIGGER IF EXISTS messages_fts_update',
+    'DROP TABLE IF EXISTS messages_fts',
+]
+
+LEGACY_RENAME = '''
+ALTER TABLE messages RENAME TO messages_legacy
+'''
+
+LEGACY_DAYS_QUERY = '''
+SELECT DISTINCT substr(timestamp, 1, 10)
+FROM messages_legacy
+WHERE timestamp >= ?
+'''
+
+LEGACY_COPY_DAY = '''
+INSERT INTO {table}(timestamp, server_id, channel_id, user_id, msg_type, content, clean_content)
+SELECT timestamp, server_id, channel_id, user_id, msg_type, compress_content(content, clean_content),
+       clean_content
+FROM messages_legacy
+WHERE timestamp >= ?
+  AND timestamp < ?
+ORDER BY rowid
+'''
+
+LEGACY_CLEAR_DAY = '''
+DELETE FROM {table}
+WHERE timestamp >= ?
+  AND timestamp < ?
+'''
+
+LEGACY_DROP = '''
+DROP TABLE messages_legacy
+'''
+
+INSERT_QUERY = '''
+INSERT INTO {table}(timestamp, server_id, channel_id, user_id, msg_type, content, clean_content)
+VALUES(?1, ?2, ?3, ?4, ?5, compress_content(?6, ?7), ?7)
+'''
+
+# For partitions that schema 2 hasn't rebuilt yet, whose content is still TEXT NOT NULL.  The
+# rebuild compresses it when it copies the row.
+INSERT_UNCOMPRESSED_QUERY = '''
+INSERT INTO {table}(timestamp, server_id, channel_id, user_id, msg_type, content, clean_content)
+VALUES(?1, ?2, ?3, ?4, ?5, ?6, ?7)
+'''
 
+INSERT_EXTRA_QUERY = '''
+INSERT INTO {table}_extras(message_rowid, position, kind, data)
+VALUES(?, ?, ?, ?)
+'''
+
+# The layout before schema 2, used by storagebench for comparison
+BENCHMARK_INLINE_PARTITION = '''
+CREATE TABLE {table}(
+  rowid INTEGER PRIMARY KEY ASC AUTOINCREMENT,
+  timestamp TEXT NOT NULL,
+  server_id INTEGER NOT NULL,
+  channel_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  msg_type TEXT NOT NULL,
+  content TEXT NOT NULL,
+  clean_content TEXT NOT NULL)
+'''
+
+BENCHMARK_INLINE_INSERT = '''
+INSERT INTO {table}(timestamp, server_id, channel_id, user_id, msg_type, content, clean_content)
+VALUES(?, ?, ?, ?, ?, ?, ?)
+'''
+
+# The partition templates below return the newest rows since a timestamp and older than a
+# (timestamp, rowid) key, which are bound after the template's own values; pages are collected
+# across partitions from newest to oldest.  The leading rowid column is only used as the key and is not displayed, and extras are
+# shown as part of the message.
 USER_QUERY = '''
-SELECT * FROM (
-    SELECT timestamp, channel_id, msg_type, clean_content
-    FROM messages INDEXED BY idx_messages_server_id_user_id_timestamp
-    WHERE server_id = ?
-      AND user_id = ?
-    ORDER BY timestamp DESC
-    LIMIT ?
-)
-ORDER BY timestamp ASC
+SELECT rowid, timestamp, channel_id, msg_type, clean_content,
+       (SELECT group_concat(kind || ': ' || data, char(10))
+        FROM {table}_extras
+        WHERE message_rowid = {table}.rowid) AS extras
+FROM {table} INDEXED BY idx_{table}_server_id_user_id_timestamp
+WHERE server_id = ?
+  AND user_id = ?
+  AND timestamp >= ?
+  AND timestamp <= ?
+  AND (timestamp < ? OR rowid < ?)
+ORDER BY timestamp DESC, rowid DESC
+LIMIT ?
 '''
 
 CHANNEL_QUERY = '''
-SELECT * FROM (
-    SELECT timestamp, user_id, msg_type, clean_content
-    FROM messages INDEXED BY idx_messages_server_id_channel_id_timestamp
-    WHERE server_id = ?
-      AND channel_id = ?
-      AND user_id <> ?
-    ORDER BY timestamp DESC
-    LIMIT ?
-)
-ORDER BY timestamp ASC
+SELECT rowid, timestamp, user_id, msg_type, clean_content,
+       (SELECT group_concat(kind || ': ' || data, char(10))
+        FROM {table}_extras
+        WHERE message_rowid = {table}.rowid) AS extras
+FROM {table} INDEXED BY idx_{table}_server_id_channel_id_timestamp
+WHERE server_id = ?
+  AND channel_id = ?
+  AND user_id <> ?
+  AND timestamp >= ?
+  AND timestamp <= ?
+  AND (timestamp < ? OR rowid < ?)
+ORDER BY timestamp DESC, rowid DESC
+LIMIT ?
 '''
 
 USER_CHANNEL_QUERY = '''
-SELECT * FROM (
-    SELECT timestamp, msg_type, clean_content
-    FROM messages INDEXED BY idx_messages_server_id_channel_id_user_id_timestamp
-    WHERE server_id = ?
-      AND user_id = ?
-      AND channel_id = ?
-    ORDER BY timestamp DESC
-    LIMIT ?
-)
-ORDER BY timestamp ASC
+SELECT rowid, timestamp, msg_type, clean_content,
+       (SELECT group_concat(kind || ': ' || data, char(10))
+        FROM {table}_extras
+        WHERE message_rowid = {table}.rowid) AS extras
+FROM {table} INDEXED BY idx_{table}_server_id_channel_id_user_id_timestamp
+WHERE server_id = ?
+  AND user_id = ?
+  AND channel_id = ?
+  AND timestamp >= ?
+  AND timestamp <= ?
+  AND (timestamp < ? OR rowid < ?)
+ORDER BY timestamp DESC, rowid DESC
+LIMIT ?
 '''
 
 CONTENT_QUERY = '''
-SELECT * FROM (
-    SELECT timestamp, channel_id, user_id, msg_type, clean_content
-    FROM messages INDEXED BY idx_messages_server_id_clean_content
-    WHERE server_id = ?
-      AND lower(clean_content) LIKE lower(?)
-      AND user_id <> ?
-    ORDER BY timestamp DESC
-    LIMIT ?
-)
-ORDER BY timestamp ASC
+SELECT rowid, timestamp, channel_id, user_id, msg_type, clean_content,
+       (SELECT group_concat(kind || ': ' || data, char(10))
+        FROM {table}_extras
+        WHERE message_rowid = {table}.rowid) AS extras
+FROM {table} INDEXED BY idx_{table}_server_id_timestamp
+WHERE server_id = ?
+  AND lower(clean_content) LIKE lower(?)
+  AND user_id <> ?
+  AND timestamp >= ?
+  AND timestamp <= ?
+  AND (timestamp < ? OR rowid < ?)
+ORDER BY timestamp DESC, rowid DESC
+LIMIT ?
 '''
 
-DELETE_BEFORE_QUERY = '''
-DELETE
-FROM messages
-WHERE timestamp  < ?
+# Returns the best matches of each partition; the rank column is used to merge partitions
+FTS_CONTENT_QUERY = '''
+SELECT m.timestamp, m.channel_id, m.user_id, m.msg_type, m.clean_content,
+       (SELECT group_concat(kind || ': ' || data, char(10))
+        FROM {table}_extras
+        WHERE message_rowid = m.rowid) AS extras,
+       f.rank
+FROM {table}_fts f
+JOIN {table} m ON m.rowid = f.rowid
+WHERE {table}_fts MATCH ?
+  AND m.server_id = ?
+  AND m.user_id <> ?
+  AND m.timestamp >= ?
+  AND m.timestamp <= ?
+ORDER BY f.rank
+LIMIT ?
 '''
 
 GET_USER_DATA_QUERY = '''
-SELECT * FROM (
-    SELECT timestamp, channel_id, msg_type, clean_content
-    FROM messages INDEXED BY idx_messages_server_id_user_id_timestamp
-    WHERE user_id = ?
-    ORDER BY timestamp DESC
-)
+SELECT timestamp, channel_id, msg_type, clean_content
+FROM messages
+WHERE user_id = ?
 ORDER BY timestamp ASC
 '''
 
 DELETE_USER_DATA_QUERY = '''
 DELETE
-FROM messages
+FROM {table}
 WHERE user_id = ?
 '''
 
 
-async def conn_attributes(conn):
-    conn.setdecoding(pyodbc.SQL_CHAR, encoding='utf-8')
-    conn.setdecoding(pyodbc.SQL_WCHAR, encoding='utf-8')
-    conn.setdecoding(pyodbc.SQL_WMETADATA, encoding='utf-16le')
-    conn.setencoding(encoding='utf-8')
+def fts_match_expression(text: str) -> str:
+    """Quote each word of the user's text so FTS5 treats it as a literal term."""
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+class LogTime(commands.Converter):
+    """A time in DISCORD_DEFAULT_TZ, converted to a stored timestamp."""
+
+    async def convert(self, ctx, argument) -> str:
+        return parse_log_time(argument)
+
+
+def parse_log_time(argument: str) -> str:
+    """Parse 'YYYY-MM-DD[ HH:MM[:SS]]', 'HH:MM' (today) or an age like 90m, 2h or 1d."""
+    argument = argument.strip().lower()
+    match = LOG_AGE_PATTERN.match(argument)
+    if match:
+        age = timedelta(**{LOG_AGE_UNITS[match.group(2)]: int(match.group(1))})
+        return format_timestamp(datetime.utcnow() - age)
+
+    for time_format in LOG_TIME_FORMATS:
+        try:
+            parsed = datetime.strptime(argument, time_format)
+        except ValueError:
+            continue
+        if time_format == '%H:%M':
+            parsed = datetime.combine(datetime.now(DISCORD_DEFAULT_TZ).date(), parsed.time())
+        parsed = DISCORD_DEFAULT_TZ.localize(parsed).astimezone(pytz.utc).replace(tzinfo=None)
+        return format_timestamp(parsed)
+
+    raise commands.BadArgument('Could not read the time {}, use YYYY-MM-DD HH:MM, HH:MM or an age '
+                               'like 2h'.format(argument))
 
 
 class SqlActivityLogger(commands.Cog):
@@ -176,7 +464,24 @@ class SqlActivityLogger(commands.Cog):
         self.lock = True
         self.insert_timing = deque(maxlen=1000)
         self.db_path = DB_FILE
-        self.pool = None
+        self.db = None
+        self.fts_enabled = False
+        self.partitions = []
+        self.partition_lock = asyncio.Lock()
+        self._purge_loop = None
+        self._migration = None
+        self.migration_status = 'not started'
+
+        self.queue = asyncio.Queue(maxsize=MAX_QUEUED_ROWS)
+        self.spool_lock = asyncio.Lock()
+        self.spool_buffer = []
+        self.spool_full = asyncio.Event()
+        self._spool_flush = None
+        self.stopping = False
+        self._flush_loop = None
+
+        # (channel id, user id) -> the exlog query to continue with exlog next
+        self.continuations = {}
 
     async def red_get_data_for_user(self, *, user_id):
         """Get a user's personal data."""
@@ -208,44 +513,138 @@ class SqlActivityLogger(commands.Cog):
         if requester not in ("discord_deleted_user", "owner"):
             return
 
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(DELETE_USER_DATA_QUERY, [user_id])
+        partitions = self.partitions
+
+        def delete(conn):
+            for table in partitions:
+                conn.execute(DELETE_USER_DATA_QUERY.format(table=table), [user_id])
+
+        await self.db.write(delete)
 
     def cog_unload(self):
         logger.debug('Seniority: unloading')
         self.lock = True
-        if self.pool:
-            self.pool.close()
-            self.bot.loop.create_task(self.pool.wait_closed())
-            self.pool = None
+        if self._purge_loop:
+            self._purge_loop.cancel()
+        if self._migration:
+            self._migration.cancel()
+        if self.db:
+            self.bot.loop.create_task(self.drain_and_close())
         else:
-            logger.error('unexpected error: pool was None')
+            logger.error('unexpected error: db was None')
         logger.debug('Seniority: unloading complete')
 
+    async def drain_and_close(self):
+        self.stopping = True
+        if self._flush_loop:
+            await self._flush_loop
+        if self._spool_flush:
+            # Cancelling could drop rows already taken from the buffer, so wake it and wait instead
+            self.spool_full.set()
+            await self._spool_flush
+        await self.flush_spool()
+        db, self.db = self.db, None
+        await db.close()
+
     async def init(self):
         logger.debug('SQLActivityLog: init')
         if not self.lock:
             logger.info('SQLActivityLog: bailing on unlock')
             return
 
-        if os.name != 'nt' and sys.platform != 'win32':
-            dsn = 'Driver=SQLite3;Database=' + self.db_path
-        else:
-            dsn = 'Driver=SQLite3 ODBC Driver;Database=' + self.db_path
-        self.pool = await aioodbc.create_pool(dsn=dsn, autocommit=True, after_created=conn_attributes)
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(CREATE_TABLE)
-                await cur.execute(CREATE_INDEX_1)
-                await cur.execute(CREATE_INDEX_2)
-                await cur.execute(CREATE_INDEX_3)
-                await cur.execute(CREATE_INDEX_4)
+        self.db = SqliteEngine(self.db_path, functions=SQL_FUNCTIONS)
+        await self.db.open()
+        await self.init_partitions()
         await self.purge()
+        self._flush_loop = self.bot.loop.create_task(self.flush_loop())
+        self._purge_loop = self.bot.loop.create_task(self.purge_loop())
+        self._migration = self.bot.loop.create_task(self.run_migrations())
         self.lock = False
+        await self.replay_spool()
 
         logger.debug('SQLActivityLog: init complete')
 
+    async def init_partitions(self):
+        tables = await self.db.fetchall(LIST_TABLES_QUERY)
+        partitions = {r[0] for r in tables if PARTITION_PATTERN.match(r[0])}
+        self.fts_enabled = await self.db.write(check_fts, transaction=False)
+
+        row = await self.db.fetchone(TABLE_TYPE_QUERY, ['messages'])
+        legacy = await self.db.fetchone(TABLE_TYPE_QUERY, ['messages_legacy'])
+        if (row and row[0] == 'table') or legacy:
+            partitions.update(await self.db.write(partial(migrate_legacy_table, fts=self.fts_enabled),
+                                                  transaction=False))
+
+        partitions.add(partition_name(format_timestamp(datetime.utcnow())))
+        partitions = sorted(partitions)
+
+        def setup(conn):
+            for table in partitions:
+                create_partition(conn, table, self.fts_enabled)
+            rebuild_view(conn, partitions)
+
+        await self.db.write(setup)
+        self.partitions = partitions
+
+    async def run_migrations(self):
+        self.migration_status = 'running'
+        try:
+            version = await self.db.migrate([
+                (1, partial(self.rebuild_partitions, schema=1, column='server_id', current_type='INTEGER')),
+                (2, partial(self.rebuild_partitions, schema=2, column='content', current_type='BLOB')),
+            ])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('SQLActivityLog: schema migration failed')
+            self.migration_status = 'failed, see the log'
+            return
+        self.migration_status = 'complete, schema version {}'.format(version)
+
+    async def rebuild_partitions(self, db, schema, column, current_type):
+        """Rebuild every partition whose column isn't declared as current_type yet.
+
+        Rows are copied in chunks, then the remainder is copied and the tables swapped in one
+        transaction.  A copy interrupted by a restart resumes from its last rowid.  Partitions
+        are always rebuilt into the current schema, so later steps skip what earlier ones did.
+        """
+        tables = list(self.partitions)
+        for number, table in enumerate(tables, 1):
+            declared = await db.read(partial(partition_column_type, table=table, column=column))
+            if declared is None or declared.upper() == current_type:
+                continue
+            total = (await db.fetchone(COUNT_ROWS_QUERY.format(table=table)))[0]
+            copied = 0
+            while True:
+                self.migration_status = 'schema {}, {} ({}/{}), {}/{} rows copied'.format(
+                    schema, table, number, len(tables), copied, total)
+                rows = await db.write(partial(copy_migration_chunk, table=table))
+                if not rows:
+                    break
+                copied += rows
+
+            async with self.partition_lock:
+                swap = partial(swap_migrated_partition, table=table, partitions=self.partitions,
+                               fts=self.fts_enabled)
+                await db.write(swap)
+            logger.info('SQLActivityLog: migrated {} to schema {} ({}/{})'.format(
+                table, schema, number, len(tables)))
+
+    async def ensure_partitions(self, tables):
+        async with self.partition_lock:
+            missing = [t for t in tables if t not in self.partitions]
+            if not missing:
+                return
+            partitions = sorted(self.partitions + missing)
+
+            def setup(conn):
+                for table in missing:
+                    create_partition(conn, table, self.fts_enabled)
+                rebuild_view(conn, partitions)
+
+            await self.db.write(setup)
+            self.partitions = partitions
+
     @commands.command()
     @checks.is_owner()
     async def rawquery(self, ctx, *, query: str):
@@ -255,10 +654,53 @@ class SqlActivityLogger(commands.Cog):
     @checks.is_owner()
     async def inserttiming(self, ctx):
         size = len(self.insert_timing)
-        avg_time = round(sum(self.insert_timing) / size, 4)
-        max_time = round(max(self.insert_timing), 4)
-        min_time = round(min(self.insert_timing), 4)
-        await ctx.send(inline('{} inserts, min={} max={} avg={}'.format(size, min_time, max_time, avg_time)))
+        if not size:
+            await ctx.send(inline('No batches written yet, {} rows queued'.format(self.queue.qsize())))
+            return
+        batch_times = [t for _, t in self.insert_timing]
+        row_count = sum(c for c, _ in self.insert_timing)
+        avg_time = round(sum(batch_times) / size, 4)
+        max_time = round(max(batch_times), 4)
+        min_time = round(min(batch_times), 4)
+        row_time = round(sum(batch_times) / row_count * 1000, 4)
+        await ctx.send(inline('{} batches ({} rows, {} queued), batch min={} max={} avg={}, per row={}ms'.format(
+            size, row_count, self.queue.qsize(), min_time, max_time, avg_time, row_time)))
+
+    @commands.command()
+    @checks.is_owner()
+    async def storagebench(self, ctx, rows: int = 10000):
+        """Compare the size and insert time of the old and compressed layouts on a synthetic corpus."""
+        rows = max(1, min(rows, 200000))
+        await ctx.send(inline('Inserting {} synthetic rows into each layout'.format(rows)))
+        results = await self.bot.loop.run_in_executor(None, benchmark_storage, rows)
+
+        tbl = prettytable.PrettyTable(['Layout', 'Size (KiB)', 'Bytes/row', 'Insert (s)', 'us/row'])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for layout, size, seconds in results:
+            tbl.add_row([layout, size // 1024, round(size / rows), round(seconds, 3),
+                         round(seconds / rows * 10 ** 6, 1)])
+        await ctx.send(box(tbl.get_string()))
+
+    @commands.command()
+    @checks.is_owner()
+    async def exlogplans(self, ctx):
+        """Check that every exlog query shape is planned as an index range scan."""
+        table = self.partitions[-1]
+        results = await self.db.read(lambda conn: [(name,) + check_query_plan(conn, table, template, ranged)
+                                                   for name, template, ranged in PLANNED_QUERIES])
+        lines = []
+        for name, details, problems in results:
+            lines.append('{}: {}'.format(name, 'FAIL, ' + '; '.join(problems) if problems else 'OK'))
+            lines.extend('    ' + d for d in details)
+        for p in pagify('\n'.join(lines)):
+            await ctx.send(box(p))
+
+    @commands.command()
+    @checks.is_owner()
+    async def migrationstatus(self, ctx):
+        await ctx.send(inline('Schema migration: {}'.format(self.migration_status)))
 
     @commands.command()
     @checks.is_owner()
@@ -267,9 +709,13 @@ class SqlActivityLogger(commands.Cog):
 
         This is useful if you need to use sqlite3 to access the database for some reason.
         Will keep the bot from locking up trying to insert records.
+        Messages seen while locked are spooled to disk and inserted when unlocked.
         """
         self.lock = not self.lock
         await ctx.send(inline('Locked is now {}'.format(self.lock)))
+        if not self.lock and self.db:
+            replayed = await self.replay_spool()
+            await ctx.send(inline('Inserted {} spooled rows'.format(replayed)))
 
     @commands.group()
     @commands.guild_only()
@@ -281,18 +727,18 @@ class SqlActivityLogger(commands.Cog):
         """
 
     @exlog.command()
-    async def user(self, ctx, user: discord.User, count=10):
-        """exlog user "{0.author.name}" 100
+    async def user(self, ctx, user: discord.User, count=10, since: LogTime = None, until: LogTime = None):
+        """exlog user "{0.author.name}" 100 "2020-12-24 14:00" "2020-12-24 15:00"
 
         List of messages for a user across all channels.
         Count is optional, with a low default and a maximum value.
+        Since and until are optional times (PT) as YYYY-MM-DD HH:MM, HH:MM today, or an age like 2h.
         """
         count = min(count, MAX_LOGS)
         server = ctx.guild
         values = [
             server.id,
             user.id,
-            count
         ]
         column_data = [
             ('timestamp', 'Time (PT)'),
@@ -301,14 +747,16 @@ class SqlActivityLogger(commands.Cog):
             ('clean_content', 'Message'),
         ]
 
-        await self.query_and_show(ctx, server, USER_QUERY, values, column_data)
+        await self.stream_results(ctx, server, USER_QUERY, values, column_data, count, since, until)
 
     @exlog.command()
-    async def channel(self, ctx, channel: discord.TextChannel, count=10):
-        """exlog channel #general_chat 100
+    async def channel(self, ctx, channel: discord.TextChannel, count=10, since: LogTime = None,
+                      until: LogTime = None):
+        """exlog channel #general_chat 100 2h
 
         List of messages in a given channel.
         Count is optional, with a low default and a maximum value.
+        Since and until are optional times (PT) as YYYY-MM-DD HH:MM, HH:MM today, or an age like 2h.
         The bot is excluded from results.
         """
         count = min(count, MAX_LOGS)
@@ -317,7 +765,6 @@ class SqlActivityLogger(commands.Cog):
             server.id,
             channel.id,
             self.bot.user.id,
-            count
         ]
         column_data = [
             ('timestamp', 'Time (PT)'),
@@ -326,14 +773,16 @@ class SqlActivityLogger(commands.Cog):
             ('clean_content', 'Message'),
         ]
 
-        await self.query_and_show(ctx, server, CHANNEL_QUERY, values, column_data)
+        await self.stream_results(ctx, server, CHANNEL_QUERY, values, column_data, count, since, until)
 
     @exlog.command()
-    async def userchannel(self, ctx, user: discord.User, channel: discord.TextChannel, count=10):
-        """exlog userchannel "{0.author.name}" #general_chat 100
+    async def userchannel(self, ctx, user: discord.User, channel: discord.TextChannel, count=10,
+                          since: LogTime = None, until: LogTime = None):
+        """exlog userchannel "{0.author.name}" #general_chat 100 14:00 15:00
 
         List of messages from a user in a given channel.
         Count is optional, with a low default and a maximum value.
+        Since and until are optional times (PT) as YYYY-MM-DD HH:MM, HH:MM today, or an age like 2h.
         """
         count = min(count, MAX_LOGS)
         server = channel.guild
@@ -341,7 +790,6 @@ class SqlActivityLogger(commands.Cog):
             server.id,
             user.id,
             channel.id,
-            count
         ]
         column_data = [
             ('timestamp', 'Time (PT)'),
@@ -349,29 +797,45 @@ class SqlActivityLogger(commands.Cog):
             ('clean_content', 'Message'),
         ]
 
-        await self.query_and_show(ctx, server, USER_CHANNEL_QUERY, values, column_data)
+        await self.stream_results(ctx, server, USER_CHANNEL_QUERY, values, column_data, count, since, until)
 
     @exlog.command()
-    async def query(self, ctx, query, count=10):
-        """exlog query "4 whale" 100
+    async def query(self, ctx, query, count=10, since: LogTime = None, until: LogTime = None):
+        """exlog query "4 whale" 100 1d
 
         Case-insensitive search of messages from every user/channel.
         Put the query in quotes if it is more than one word.
+        Messages containing every word of the query are returned, best matches first.
+        Queries containing % or _ are matched as a LIKE pattern instead.
         Count is optional, with a low default and a maximum value.
+        Since and until are optional times (PT) as YYYY-MM-DD HH:MM, HH:MM today, or an age like 2h.
         The bot is excluded from results.
         """
-        if query[0] in ('%', '_'):
-            await ctx.send('`You cannot start this query with a wildcard`')
-            return
-
         count = min(count, MAX_LOGS)
         server = ctx.guild
-        values = [
-            server.id,
-            query,
-            self.bot.user.id,
-            count
-        ]
+
+        if self.fts_enabled and not any(c in query for c in ('%', '_')):
+            values = [
+                fts_match_expression(query),
+                server.id,
+                self.bot.user.id,
+                since or '',
+                until or START_KEY[0],
+            ]
+            sql = FTS_CONTENT_QUERY
+            ranked = True
+        else:
+            if query[0] in ('%', '_'):
+                await ctx.send('`You cannot start this query with a wildcard`')
+                return
+            values = [
+                server.id,
+                query,
+                self.bot.user.id,
+            ]
+            sql = CONTENT_QUERY
+            ranked = False
+
         column_data = [
             ('timestamp', 'Time (PT)'),
             ('channel_id', 'Channel'),
@@ -380,28 +844,103 @@ class SqlActivityLogger(commands.Cog):
             ('clean_content', 'Message'),
         ]
 
-        await self.query_and_show(ctx, server, CONTENT_QUERY, values, column_data)
+        if ranked:
+            await self.query_and_show(ctx, server, sql, values, column_data, count=count, since=since,
+                                      until=until)
+        else:
+            await self.stream_results(ctx, server, sql, values, column_data, count, since, until)
+
+    @exlog.command(name='next')
+    async def _next(self, ctx, count=10):
+        """exlog next 100
 
-    async def query_and_show(self, ctx, server, query, values, column_data, max_rows=MAX_LOGS * 2, verbose=True):
-        result_text = await self.query_and_save(ctx, server, query, values, column_data, max_rows, verbose)
+        Continue your last exlog user, channel, userchannel or wildcard query in this channel
+        with the next (older) messages.
+        Count is optional, with a low default and a maximum value.
+        """
+        continuation = self.continuations.pop((ctx.channel.id, ctx.author.id), None)
+        if continuation is None:
+            await ctx.send(inline('There is no query to continue'))
+            return
+        query, values, column_data, since, key = continuation
+        await self.stream_results(ctx, ctx.guild, query, values, column_data, min(count, MAX_LOGS),
+                                  since, key=key)
+
+    async def stream_results(self, ctx, server, query, values, column_data, count, since=None, until=None,
+                             key=None):
+        """Send up to count rows of a keyset partition template, newest first, a page at a time.
+
+        Rows are limited to those between since and until (stored timestamps), or start at key.
+
+        Only one page is held at once.  If the rows ran out before count, the query is finished,
+        otherwise it is saved so that exlog next can continue from the last key.
+        """
+        before_time = timeit.default_timer()
+        since = since or ''
+        key = key or (until or START_KEY[0], START_KEY[1])
+        sent = 0
+        finished = False
+        while sent < count:
+            limit = min(EXLOG_PAGE_ROWS, count - sent)
+            columns, rows = await self.fetch_page(query, values, since, key, limit)
+            if rows:
+                key = (rows[-1]['timestamp'], rows[-1]['rowid'])
+                sent += len(rows)
+                table = self.render_table(server, columns[1:], [tuple(r)[1:] for r in rows], column_data)
+                for p in pagify(table):
+                    await ctx.send(box(p))
+            if len(rows) < limit:
+                finished = True
+                break
+
+        execution_time = timeit.default_timer() - before_time
+        summary = '{} results sent in {}s'.format(sent, round(execution_time, 2))
+        if finished:
+            self.continuations.pop((ctx.channel.id, ctx.author.id), None)
+        else:
+            self.continuations[(ctx.channel.id, ctx.author.id)] = (query, values, column_data, since, key)
+            summary += ', use {}exlog next for older messages'.format(ctx.clean_prefix)
+        await ctx.send(inline(summary))
+
+    async def query_and_show(self, ctx, server, query, values, column_data, max_rows=MAX_LOGS * 2, verbose=True,
+                             count=None, since=None, until=None):
+        result_text = await self.query_and_save(ctx, server, query, values, column_data, max_rows, verbose,
+                                                count, since, until)
         for p in pagify(result_text):
             await ctx.send(box(p))
 
-    async def query_and_save(self, ctx, server, query, values, column_data, max_rows=MAX_LOGS * 2, verbose=True):
+    async def query_and_save(self, ctx, server, query, values, column_data, max_rows=MAX_LOGS * 2, verbose=True,
+                             count=None, since=None, until=None):
+        """Run a query and render the results as a table.
+
+        If count is None the query is run as-is, otherwise it is a ranked partition template and
+        the best ranked count rows across the partitions between since and until are returned.
+        """
         before_time = timeit.default_timer()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(query, values)
-                rows = await cur.fetchall()
-                results_columns = [d[0] for d in cur.description]
+        if count is None:
+            results_columns, rows = await self.fetch_all(query, values)
+        else:
+            results_columns, rows = await self.fetch_ranked(query, values, count, since, until)
 
         execution_time = timeit.default_timer() - before_time
 
+        result_text = ""
+        if verbose:
+            result_text = "{} results fetched in {}s\n{}".format(
+                len(rows), round(execution_time, 2),
+                self.render_table(server, results_columns, rows, column_data, max_rows))
+        return result_text
+
+    def render_table(self, server, results_columns, rows, column_data, max_rows=MAX_LOGS * 2):
         if len(column_data) == 0:
             column_data = ALL_COLUMNS
 
         column_data = [r for r in column_data if r[0] in results_columns]
+        # Attachments and embeds are shown under the message they belong to
+        show_extras = 'extras' in results_columns and 'clean_content' in [c[0] for c in column_data]
         for missing_col in [col for col in results_columns if col not in [c[0] for c in column_data]]:
+            if missing_col == 'extras' and show_extras:
+                continue
             column_data.append((missing_col, missing_col))
 
         column_names = [c[0] for c in column_data]
@@ -412,47 +951,72 @@ class SqlActivityLogger(commands.Cog):
         tbl.vrules = prettytable.NONE
         tbl.align = 'l'
 
-        for idx, row in enumerate(rows):
-            if idx > max_rows:
-                break
+        renderer = RowRenderer(self.bot, server)
+        columns = list(zip(column_indices(results_columns, column_names), renderer.formatters(column_names)))
+        content_idx = column_names.index('clean_content') if 'clean_content' in column_names else None
+        extras_idx = results_columns.index('extras') if show_extras else None
+
+        for row in rows[:max_rows + 1]:
+            table_row = [fmt(row[cidx]) for cidx, fmt in columns]
+            if content_idx is not None:
+                value = table_row[content_idx]
+                if extras_idx is not None and row[extras_idx]:
+                    value = value + '\n' + row[extras_idx]
+                value = value.replace('```', '~~~')
+                value = value.replace('`', '\\`')
+                table_row[content_idx] = '\n'.join(textwrap.wrap(value, 60))
+            tbl.add_row(table_row)
 
-            table_row = list()
-            cols = next(zip(*row.cursor_description))
+        return tbl.get_string()
 
-            for col in column_names:
-                if col not in cols:
-                    table_row.append('')
-                    continue
-                raw_value = row[cols.index(col)]
-                value = str(raw_value)
-                if col == 'timestamp':
-                    # Assign a UTC timezone to the datetime
-                    raw_value = raw_value.replace(tzinfo=pytz.utc)
-                    # Change the UTC timezone to PT
-                    raw_value = DISCORD_DEFAULT_TZ.normalize(raw_value)
-                    value = raw_value.strftime("%F %X")
-                if col == 'channel_id':
-                    channel = server.get_channel(int(value)) if server else None
-                    value = channel.name if channel else value
-                if col == 'user_id':
-                    member = server.get_member(int(value)) if server else None
-                    value = member.name if member else value
-                if col == 'server_id':
-                    server_obj = self.bot.get_guild(int(value))
-                    value = server_obj.name if server_obj else value
-                if col == 'clean_content':
-                    value = value.replace('```', '~~~')
-                    value = value.replace('`', '\\`')
-                    value = '\n'.join(textwrap.wrap(value, 60))
-                table_row.append(value)
+    async def fetch_all(self, query, values):
+        return await self.db.query(query, values)
 
-            tbl.add_row(table_row)
+    async def fetch_page(self, query, values, since, key, limit):
+        """Collect the newest limit rows since a timestamp and older than key, walking partitions from
+        newest to oldest."""
+        timestamp, rowid = key
+        partitions = list(reversed(self.partitions_between(since, timestamp)))
 
-        result_text = ""
-        if verbose:
-            result_text = "{} results fetched in {}s\n{}".format(
-                len(rows), round(execution_time, 2), tbl.get_string())
-        return result_text
+        def run(conn):
+            rows = []
+            columns = []
+            for table in partitions:
+                cur = conn.execute(query.format(table=table),
+                                   values + [since, timestamp, timestamp, rowid, limit - len(rows)])
+                rows.extend(cur.fetchall())
+                columns = [d[0] for d in cur.description]
+                if len(rows) >= limit:
+                    break
+            return columns, rows
+
+        return await self.db.read(run)
+
+    async def fetch_ranked(self, query, values, count, since=None, until=None):
+        """Collect the best ranked count rows across the partitions between since and until, ordered
+        by time.
+
+        The template's last column must be the rank, lower being better.
+        """
+        partitions = self.partitions_between(since or '', until or START_KEY[0])
+
+        def run(conn):
+            rows = []
+            columns = []
+            for table in partitions:
+                cur = conn.execute(query.format(table=table), values + [count])
+                rows.extend(cur.fetchall())
+                columns = [d[0] for d in cur.description]
+            rows = sorted(rows, key=lambda r: r[-1])[:count]
+            rows = sorted((tuple(r)[:-1] for r in rows), key=lambda r: r[0])
+            return columns[:-1], rows
+
+        return await self.db.read(run)
+
+    def partitions_between(self, since, until):
+        """The partitions that can hold stored timestamps between since and until."""
+        first, last = partition_name(since), partition_name(until)
+        return [t for t in self.partitions if first <= t <= last]
 
     @commands.Cog.listener("on_message_edit")
     async def on_message_edit(self, before, after):
@@ -463,54 +1027,423 @@ class SqlActivityLogger(commands.Cog):
         await self.log('DELETE', message, datetime.utcnow())
 
     async def log(self, msg_type, message, timestamp):
-        if self.lock:
-            return
-
         if message.author.id == self.bot.user.id:
             return
 
-        stmt = '''
-          INSERT INTO messages(timestamp, server_id, channel_id, user_id, msg_type, content, clean_content)
-          VALUES(?, ?, ?, ?, ?, ?, ?)
-        '''
         timestamp = timestamp or datetime.utcnow()
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
         server_id = message.guild.id if message.guild else -1
         channel_id = message.channel.id if message.channel else -1
 
-        msg_content = message.content
-        msg_clean_content = message.clean_content
-        if message.attachments:
-            extra_txt = '\nattachments: ' + str(message.attachments)
-            msg_content = (msg_content + extra_txt).strip()
-            msg_clean_content = (msg_clean_content + extra_txt).strip()
-
-        if message.embeds:
-            extra_txt = '\nembeds: ' + str(message.embeds)
-            msg_content = (msg_content + extra_txt).strip()
-            msg_clean_content = (msg_clean_content + extra_txt).strip()
+        extras = [('attachment', a.url) for a in message.attachments]
+        extras += [('embed', json.dumps(e.to_dict())) for e in message.embeds]
 
         values = [
-            timestamp,
+            format_timestamp(timestamp),
             server_id,
             channel_id,
             message.author.id,
             msg_type,
-            msg_content,
-            msg_clean_content,
+            message.content,
+            message.clean_content,
+            extras,
         ]
 
+        if self.lock:
+            self.spool(values)
+            return
+
+        await self.queue.put(values)
+
+    def spool(self, values):
+        self.spool_buffer.append(json.dumps(values) + '\n')
+        if len(self.spool_buffer) >= FLUSH_BATCH_SIZE:
+            self.spool_full.set()
+        if self._spool_flush is None or self._spool_flush.done():
+            self._spool_flush = self.bot.loop.create_task(self.spool_flush_later())
+
+    async def spool_flush_later(self):
+        try:
+            await asyncio.wait_for(self.spool_full.wait(), FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        await self.flush_spool()
+
+    async def flush_spool(self):
+        async with self.spool_lock:
+            await self.write_spool_buffer()
+
+    async def write_spool_buffer(self):
+        """Append the buffered rows to the spool file off the event loop; call with spool_lock held."""
+        lines, self.spool_buffer = self.spool_buffer, []
+        self.spool_full.clear()
+        if not lines:
+            return
+        try:
+            await self.bot.loop.run_in_executor(None, append_lines, SPOOL_FILE, lines)
+        except OSError:
+            logger.exception('Failed to spool {} log rows'.format(len(lines)))
+            # keep them for the next flush rather than dropping them
+            self.spool_buffer[:0] = lines
+
+    async def replay_spool(self):
+        """Insert the rows spooled while locked, in batches, returning how many were inserted.
+
+        A replay interrupted by a restart is finished on the next one; rows it had already
+        inserted are inserted again.
+        """
+        replayed = 0
+        async with self.spool_lock:
+            await self.write_spool_buffer()
+            for path in (SPOOL_REPLAY_FILE, SPOOL_FILE):
+                if not os.path.exists(path):
+                    continue
+                if path == SPOOL_FILE:
+                    os.replace(SPOOL_FILE, SPOOL_REPLAY_FILE)
+                replayed += await self.replay_file(SPOOL_REPLAY_FILE)
+                os.remove(SPOOL_REPLAY_FILE)
+        if replayed:
+            logger.info('Inserted {} spooled log rows'.format(replayed))
+        return replayed
+
+    async def replay_file(self, path):
+        replayed = 0
+        batch = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    logger.warning('Skipping a malformed spooled log row')
+                    continue
+                if len(batch) >= FLUSH_BATCH_SIZE:
+                    await self.write_batch(batch)
+                    replayed += len(batch)
+                    batch = []
+        if batch:
+            await self.write_batch(batch)
+            replayed += len(batch)
+        return replayed
+
+    async def flush_loop(self):
+        while not (self.stopping and self.queue.empty()):
+            batch = await self.next_batch()
+            if not batch:
+                continue
+            try:
+                await self.write_batch(batch)
+            except Exception:
+                logger.exception('Failed to write {} log rows'.format(len(batch)))
+
+    async def next_batch(self):
+        batch = []
+        deadline = self.bot.loop.time() + FLUSH_INTERVAL_SECONDS
+        while len(batch) < FLUSH_BATCH_SIZE:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - self.bot.loop.time()
+            if timeout <= 0 or self.stopping:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def write_batch(self, batch):
         before_time = timeit.default_timer()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(stmt, *values)
+        batches = defaultdict(list)
+        for values in batch:
+            batches[partition_name(values[0])].append(values)
+        await self.ensure_partitions(batches)
+
+        def insert(conn):
+            for table, rows in batches.items():
+                insert_rows(conn, table, rows)
+
+        await self.db.write(insert)
         execution_time = timeit.default_timer() - before_time
-        self.insert_timing.append(execution_time)
+        self.insert_timing.append((len(batch), execution_time))
+
+    async def purge_loop(self):
+        while True:
+            await asyncio.sleep(PURGE_INTERVAL_SECONDS)
+            try:
+                await self.purge()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Failed to purge old logs')
 
     async def purge(self):
-        before = datetime.today() - timedelta(days=(7 * 3))
-        values = [before]
+        cutoff = partition_name(format_timestamp(datetime.utcnow() - timedelta(days=RETENTION_DAYS)))
         logger.debug('Purging old logs')
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(DELETE_BEFORE_QUERY, values)
-                logger.debug('Purged {}'.format(cur.rowcount))
+        async with self.partition_lock:
+            expired = [t for t in self.partitions if t < cutoff]
+            if not expired:
+                return
+            partitions = [t for t in self.partitions if t >= cutoff]
+
+            def drop(conn):
+                rebuild_view(conn, partitions)
+                for table in expired:
+                    conn.execute(DROP_FTS.format(table=table))
+                    conn.execute(DROP_EXTRAS.format(table=table))
+                    conn.execute(DROP_PARTITION.format(table=table))
+                    conn.execute(DROP_PARTITION.format(table=table + MIGRATING_SUFFIX))
+
+            self.partitions = partitions
+            await self.db.write(drop)
+        logger.debug('Purged {}'.format(', '.join(expired)))
+
+
+# Query shapes checked by exlogplans: name, template, and whether it should be a timestamp range scan
+PLANNED_QUERIES = [
+    ('user', USER_QUERY, True),
+    ('channel', CHANNEL_QUERY, True),
+    ('userchannel', USER_CHANNEL_QUERY, True),
+    ('query (wildcard)', CONTENT_QUERY, True),
+    ('query (full text)', FTS_CONTENT_QUERY, False),
+]
+
+
+def check_query_plan(conn, table: str, template: str, timestamp_range: bool):
+    """Plan a partition template, returning the plan lines and anything wrong with them.
+
+    A plan is wrong if it scans the partition or sorts into a temp b-tree, or if timestamp_range
+    is set and it doesn't search an index on a bounded timestamp range.
+    """
+    sql = template.format(table=table)
+    details = [r[3] for r in conn.execute('EXPLAIN QUERY PLAN ' + sql, [0] * sql.count('?'))]
+    problems = [d for d in details if d.split(' ')[:2] == ['SCAN', table] or 'TEMP B-TREE' in d]
+    if timestamp_range and not any(d.startswith('SEARCH {} USING INDEX'.format(table))
+                                   and 'timestamp>?' in d and 'timestamp<?' in d for d in details):
+        problems.append('no timestamp range scan')
+    return details, problems
+
+
+def format_timestamp(timestamp: datetime) -> str:
+    return timestamp.strftime(STORED_TIMESTAMP_FORMAT)
+
+
+def partition_name(timestamp: str) -> str:
+    """Name of the partition holding a stored 'YYYY-MM-DD HH:MM:SS' timestamp."""
+    return PARTITION_PREFIX + timestamp[:10].replace('-', '')
+
+
+def create_partition(conn, table: str, fts: bool):
+    """Create a partition with its indexes and full text index, if they don't already exist."""
+    day = datetime.strptime(table[len(PARTITION_PREFIX):], '%Y%m%d')
+    conn.execute(CREATE_PARTITION.format(table=table))
+    conn.execute(SEED_PARTITION_ROWID, [table, day.toordinal() * ROWID_STRIDE, table])
+    for stmt in (CREATE_INDEX_1, CREATE_INDEX_2, CREATE_INDEX_4, CREATE_INDEX_5,
+                 CREATE_EXTRAS_TABLE, CREATE_EXTRAS_DELETE_TRIGGER):
+        conn.execute(stmt.format(table=table))
+
+    if fts:
+        fts_exists = conn.execute(TABLE_TYPE_QUERY, [table + '_fts']).fetchone()
+        for stmt in (CREATE_FTS_TABLE, CREATE_FTS_INSERT_TRIGGER,
+                     CREATE_FTS_DELETE_TRIGGER, CREATE_FTS_UPDATE_TRIGGER):
+            conn.execute(stmt.format(table=table))
+        if not fts_exists:
+            conn.execute(REBUILD_FTS.format(table=table))
+
+
+def rebuild_view(conn, partitions):
+    selects = '\nUNION ALL\n'.join('SELECT * FROM {}'.format(t) for t in partitions)
+    conn.execute(DROP_VIEW)
+    conn.execute(CREATE_VIEW.format(selects=selects))
+
+
+def partition_column_type(conn, table: str, column: str) -> Optional[str]:
+    """Declared type of a partition's column, or None if the partition doesn't exist."""
+    row = conn.execute(COLUMN_TYPE_QUERY, [table, column]).fetchone()
+    return row[0] if row else None
+
+
+def copy_migration_chunk(conn, table: str) -> int:
+    """Copy the next chunk of a partition into its _migrating table, returning the rows copied."""
+    if partition_column_type(conn, table, 'rowid') is None:
+        return 0
+    conn.execute(CREATE_PARTITION.format(table=table + MIGRATING_SUFFIX))
+    last_rowid = conn.execute(MIGRATE_LAST_ROWID.format(table=table)).fetchone()[0]
+    cur = conn.execute(MIGRATE_COPY_CHUNK.format(table=table), [last_rowid, MIGRATION_CHUNK_ROWS])
+    return cur.rowcount
+
+
+def swap_migrated_partition(conn, table: str, partitions, fts: bool):
+    """Catch a _migrating table up with its partition and replace the partition with it.
+
+    The full text index is keyed on rowid, which the copy keeps, so it is left in place.
+    """
+    if partition_column_type(conn, table, 'rowid') is None:
+        conn.execute(DROP_PARTITION.format(table=table + MIGRATING_SUFFIX))
+        return
+    while copy_migration_chunk(conn, table):
+        pass
+    conn.execute(MIGRATE_DROP_DELETED.format(table=table))
+    conn.execute(DROP_VIEW)
+    conn.execute(DROP_PARTITION.format(table=table))
+    conn.execute(MIGRATE_RENAME.format(table=table))
+    create_partition(conn, table, fts)
+    rebuild_view(conn, partitions)
+
+
+def append_lines(path: str, lines):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.writelines(lines)
+
+
+def compress_content(content: str, clean_content: str) -> Optional[bytes]:
+    if content == clean_content:
+        return None
+    compressor = zlib.compressobj(CONTENT_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                  zdict=clean_content.encode())
+    return compressor.compress(content.encode()) + compressor.flush()
+
+
+def message_content(content, clean_content: str) -> str:
+    """The original content of a stored row, also available to SQL as message_content()."""
+    if content is None:
+        return clean_content
+    if isinstance(content, str):
+        return content
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=clean_content.encode())
+    return (decompressor.decompress(content) + decompressor.flush()).decode()
+
+
+SQL_FUNCTIONS = [
+    ('compress_content', 2, compress_content),
+    ('message_content', 2, message_content),
+]
+
+
+def insert_rows(conn, table: str, rows):
+    """Insert log() values into a partition, along with their attachments and embeds."""
+    declared = partition_column_type(conn, table, 'content')
+    if declared is None or declared.upper() == 'BLOB':
+        query = INSERT_QUERY.format(table=table)
+    else:
+        query = INSERT_UNCOMPRESSED_QUERY.format(table=table)
+    conn.executemany(query, [values[:-1] for values in rows if not values[-1]])
+    for values in rows:
+        if values[-1]:
+            rowid = conn.execute(query, values[:-1]).lastrowid
+            extras = [(rowid, position, kind, data) for position, (kind, data) in enumerate(values[-1])]
+            conn.executemany(INSERT_EXTRA_QUERY.format(table=table), extras)
+
+
+def synthetic_corpus(rows: int):
+    """Deterministic log() values resembling real traffic: mentions, attachments and embeds."""
+    rng = random.Random(rows)
+    words = ['whale', 'carry', 'team', 'dungeon', 'pull', 'rem', 'stamina', 'leader', 'skill', 'awoken',
+             'the', 'a', 'is', 'on', 'my', 'for', 'and', 'lol', 'anyone', 'help', 'with', 'this']
+    start = datetime(2000, 1, 1)
+    corpus = []
+    for i in range(rows):
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(2, 40)))
+        content = clean_content = text
+        if rng.random() < 0.3:
+            user_id = rng.randrange(10 ** 17, 10 ** 18)
+            content = '<@!{}> {}'.format(user_id, text)
+            clean_content = '@user{} {}'.format(user_id % 1000, text)
+        extras = []
+        if rng.random() < 0.1:
+            extras.append(('attachment', 'https://cdn.discordapp.com/attachments/{}/{}/image.png'.format(
+                rng.randrange(10 ** 17, 10 ** 18), rng.randrange(10 ** 17, 10 ** 18))))
+        if rng.random() < 0.05:
+            extras.append(('embed', json.dumps({'type': 'rich', 'title': text[:40], 'description': text})))
+        timestamp = format_timestamp(start + timedelta(seconds=i * 86400 / rows))
+        corpus.append([timestamp, 1, rng.randrange(20), rng.randrange(500), rng.choice(['EDIT', 'DELETE']),
+                       content, clean_content, extras])
+    return corpus
+
+
+def inline_values(values):
+    """The content and clean_content that log() stored before schema 2, extras appended to both."""
+    content, clean_content = values[5], values[6]
+    attachments = ['<Attachment id=0 filename={!r} url={!r}>'.format(d.rsplit('/', 1)[-1], d)
+                   for kind, d in values[7] if kind == 'attachment']
+    embeds = ['<discord.embeds.Embed object at 0x7f0000000000>' for kind, _ in values[7] if kind == 'embed']
+    for label, items in (('attachments', attachments), ('embeds', embeds)):
+        if items:
+            extra_txt = '\n{}: [{}]'.format(label, ', '.join(items))
+            content = (content + extra_txt).strip()
+            clean_content = (clean_content + extra_txt).strip()
+    return values[:5] + [content, clean_content]
+
+
+def benchmark_storage(rows: int):
+    """Insert a synthetic corpus into each layout, returning (layout, bytes, seconds) per layout."""
+    corpus = synthetic_corpus(rows)
+    table = partition_name(corpus[0][0])
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for layout in ('inline', 'compressed'):
+            conn = sqlite3.connect(os.path.join(tmp, layout + '.db'), isolation_level=None)
+            for name, num_params, fn in SQL_FUNCTIONS:
+                conn.create_function(name, num_params, fn, deterministic=True)
+            if layout == 'inline':
+                conn.execute(BENCHMARK_INLINE_PARTITION.format(table=table))
+            create_partition(conn, table, fts=False)
+
+            before_time = timeit.default_timer()
+            conn.execute('BEGIN')
+            if layout == 'inline':
+                conn.executemany(BENCHMARK_INLINE_INSERT.format(table=table), map(inline_values, corpus))
+            else:
+                insert_rows(conn, table, corpus)
+            conn.execute('COMMIT')
+            execution_time = timeit.default_timer() - before_time
+
+            page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+            size = page_count * conn.execute('PRAGMA page_size').fetchone()[0]
+            conn.close()
+            results.append((layout, size, execution_time))
+    return results
+
+
+def check_fts(conn) -> bool:
+    try:
+        conn.execute('CREATE VIRTUAL TABLE temp.fts_probe USING fts5(x)')
+        conn.execute('DROP TABLE temp.fts_probe')
+    except sqlite3.OperationalError:
+        logger.exception('SQLActivityLog: FTS5 unavailable, falling back to LIKE queries')
+        return False
+    return True
+
+
+def migrate_legacy_table(conn, fts: bool):
+    """Move rows from the single messages table that predates partitioning into partitions.
+
+    The table is first renamed to messages_legacy.  If a restart interrupts the copy, it is
+    resumed from there, and each day's partition is cleared before that day is copied so days
+    moved the first time aren't duplicated.
+    """
+    if conn.execute(TABLE_TYPE_QUERY, ['messages_legacy']).fetchone():
+        logger.info('SQLActivityLog: resuming move of messages table into daily partitions')
+    else:
+        logger.info('SQLActivityLog: moving messages table into daily partitions')
+        conn.execute('BEGIN')
+        for stmt in LEGACY_DROP_FTS:
+            conn.execute(stmt)
+        conn.execute(LEGACY_RENAME)
+        conn.execute('COMMIT')
+
+    cutoff = (datetime.utcnow() - timedelta(days=RETENTION_DAYS)).date()
+    days = sorted(r[0] for r in conn.execute(LEGACY_DAYS_QUERY, [cutoff.isoformat()]))
+    partitions = []
+    for day in days:
+        table = partition_name(day)
+        next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).date().isoformat()
+        conn.execute('BEGIN')
+        create_partition(conn, table, fts)
+        conn.execute(LEGACY_CLEAR_DAY.format(table=table), [day, next_day])
+        moved = conn.execute(LEGACY_COPY_DAY.format(table=table), [day, next_day]).rowcount
+        conn.execute('COMMIT')
+        logger.info('SQLActivityLog: moved {} rows into {}'.format(moved, table))
+        partitions.append(table)
+    conn.execute(LEGACY_DROP)
+    return partitions